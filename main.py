@@ -1,4 +1,3 @@
-import asyncio
 from contextlib import asynccontextmanager
 
 from fastapi import FastAPI
@@ -6,10 +5,23 @@ from fastapi.exceptions import RequestValidationError
 from fastapi.staticfiles import StaticFiles
 from starlette.responses import PlainTextResponse
 
-from src.dependecies import get_settings, get_admin_publisher, get_feed_publisher, get_storeman
+from src.cluster import ClusterServer, get_role
+from src.dependecies import (
+    get_settings,
+    get_admin_publisher,
+    get_feed_publisher,
+    get_storeman,
+    get_heartbeat,
+    get_telraam_client,
+    get_fetcher,
+    get_cluster_client,
+)
 from src.routes import router
-from src.tasks.fetcher import Fetcher
+from src.tasks.config_store import ConfigStore
 from src.tasks.listener import WebSocketListener
+from src.tasks.stats import StatsReporter
+from src.tasks.supervisor import TaskSupervisor
+from src.tasks.ticker import PositionTicker
 
 
 # Start background tasks when the app starts
@@ -19,11 +31,58 @@ async def lifespan(_app: FastAPI):
     feed_publisher = await get_feed_publisher()
     admin_publisher = await get_admin_publisher()
     storeman = await get_storeman()
+    heartbeat = await get_heartbeat()
+    client = await get_telraam_client()
+    fetcher = await get_fetcher()
+    role = get_role()
+
+    supervisor = TaskSupervisor(settings, feed_publisher, admin_publisher, publish_states=role != "worker")
+    supervisor.supervise("heartbeat", heartbeat.run)
+    supervisor.supervise("position-ticker", PositionTicker(settings, feed_publisher, admin_publisher).run)
+
+    if role == "worker":
+        # The ingest process fetches from Telraam and sends every update to this worker
+        cluster_client = await get_cluster_client()
+        supervisor.supervise("cluster-client", cluster_client.start)
+        # The ingest process adds the queue statistics of every worker to its own
+        supervisor.supervise("stats", StatsReporter(settings, feed_publisher, admin_publisher).report)
+        yield
+        await supervisor.close()
+        await client.aclose()
+        return
+
+    cluster_server = None
+    if role == "ingest":
+
+        async def on_settings():
+            # A worker changed the settings, e.g. the lap source or the freeze time
+            await fetcher.publish_counts()
+            fetcher.trigger()
+
+        cluster_server = ClusterServer(
+            settings, feed_publisher, admin_publisher, on_settings, {"counts": fetcher.query_counts}
+        )
+        await cluster_server.start()
+
+    config_store = ConfigStore(
+        settings,
+        feed_publisher,
+        admin_publisher,
+        fetcher,
+        cluster_server.send_settings if cluster_server is not None else None,
+    )
+    config_store.start()
+    supervisor.supervise("config-store", config_store.run)
 
     await storeman.loadScores()
+    supervisor.supervise("storage", storeman.run)
 
-    asyncio.create_task(WebSocketListener(settings, feed_publisher, admin_publisher).start())
-    asyncio.create_task(Fetcher(settings, feed_publisher, admin_publisher, storeman).fetch())
+    supervisor.supervise(
+        "listener", WebSocketListener(settings, feed_publisher, admin_publisher, fetcher.trigger).start
+    )
+    supervisor.supervise("fetcher", fetcher.fetch)
+    supervisor.supervise("stats", StatsReporter(settings, feed_publisher, admin_publisher).report)
+    await supervisor.start()
 
     await feed_publisher.publish("frozen", settings.site.freeze is not None)
     await feed_publisher.publish("message", settings.site.message)
@@ -34,6 +93,11 @@ async def lifespan(_app: FastAPI):
 
     yield  # Signal that the startup can go ahead
 
+    await supervisor.close()
+    await config_store.close()
+    await storeman.close()
+    await client.aclose()
+
 
 app = FastAPI(
     title="Loxsi",
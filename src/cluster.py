@@ -0,0 +1,303 @@
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Awaitable, Callable, Literal
+
+from starlette.status import HTTP_400_BAD_REQUEST, HTTP_404_NOT_FOUND, HTTP_503_SERVICE_UNAVAILABLE
+
+from src.data_publisher import DataPublisher
+from src.encoding import JsonData, encode
+from src.settings import Settings
+
+Role = Literal["standalone", "ingest", "worker"]
+
+
+def _sum_stats(stats: list[dict]) -> dict:
+    """
+    Sums the queue statistics of several processes.
+
+    Args:
+        stats (list): The queue statistics of every process, as published by the StatsReporter.
+
+    Returns:
+        dict: The summed statistics.
+    """
+    return {
+        publisher: {counter: sum(process[publisher][counter] for process in stats) for counter in counters}
+        for publisher, counters in stats[0].items()
+    }
+
+
+def get_role() -> Role:
+    """
+    Returns the role of this process, configured with the LOXSI_ROLE environment variable.
+
+        standalone: Fetches from Telraam and serves the websockets, the default.
+        ingest: Fetches from Telraam and forwards every update to the workers.
+        worker: Serves the websockets with the updates received from the ingest process.
+
+    Returns:
+        Role: The role.
+    """
+    role = os.environ.get("LOXSI_ROLE", "standalone")
+    if role not in ("standalone", "ingest", "worker"):
+        raise ValueError(f"Invalid LOXSI_ROLE: {role}")
+    return role
+
+
+class ClusterServer:
+    """
+    Runs in the ingest process and forwards every publish to the connected worker processes over a Unix socket.
+
+    Each update is encoded once and the same line is written to every worker.
+    Updates published by a worker, e.g. by an admin action, are applied here and forwarded to all workers.
+    Queries that need the state of the ingest process, e.g. the laps, are answered to the worker that sent them.
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        feed_publisher: DataPublisher,
+        admin_publisher: DataPublisher,
+        on_settings: Callable[[], Awaitable[Any]] | None = None,
+        queries: dict[str, Callable[..., tuple[int, JsonData]]] | None = None,
+    ):
+        self._settings: Settings = settings
+        self._publishers: dict[str, DataPublisher] = {
+            "feed": feed_publisher,
+            "admin": admin_publisher,
+        }
+        # Called when a worker changed the settings, e.g. to publish the counts of a new lap source
+        self._on_settings: Callable[[], Awaitable[Any]] | None = on_settings
+        # Query name -> handler returning the HTTP status and the answer
+        self._queries: dict[str, Callable[..., tuple[int, JsonData]]] = queries or {}
+        self._server: asyncio.Server | None = None
+        self._workers: set[asyncio.StreamWriter] = set()
+        self._connections: dict[asyncio.StreamWriter, int] = {}
+        self._local_connections: int = 0
+        # The latest queue statistics of every worker, added to the ones of this process
+        self._stats: dict[asyncio.StreamWriter, dict] = {}
+        self.logger = logging.getLogger("uvicorn")
+
+    async def start(self):
+        """
+        Starts listening for workers and hooks into the publishers.
+        """
+        for name, publisher in self._publishers.items():
+            publisher.relay = self._relay(name, publisher)
+        self._settings.on_persist(self._persist)
+
+        if os.path.exists(self._settings.cluster.socket):
+            os.remove(self._settings.cluster.socket)
+        self._server = await asyncio.start_unix_server(
+            self._handle, path=self._settings.cluster.socket, limit=self._settings.cluster.limit
+        )
+        self.logger.info(f"Ingest listening on {self._settings.cluster.socket}")
+
+    def _relay(self, name: str, publisher: DataPublisher):
+        async def relay(topic: str, data: JsonData):
+            if name == "admin" and topic == "active-connections":
+                # Every process counts its own connections, publish the total
+                self._local_connections = data
+                data = self._local_connections + sum(self._connections.values())
+            elif name == "admin" and topic == "queue-stats":
+                # Every process reports its own queues, publish the total
+                data = _sum_stats([data, *self._stats.values()])
+            if await publisher.apply(topic, data):
+                self._write(f"{name} {encode(topic, data)}\n".encode())
+
+        return relay
+
+    def _persist(self, settings: Settings):
+        settings.write()
+        self.send_settings()
+
+    def send_settings(self):
+        """
+        Sends the settings to every worker.
+        """
+        self._write(f"settings {self._settings.model_dump_json(exclude={'source_file'})}\n".encode())
+
+    def _write(self, line: bytes):
+        """
+        Writes a line to every worker, dropping workers that can't keep up.
+
+        Args:
+            line (bytes): The encoded line.
+        """
+        for writer in list(self._workers):
+            if writer.transport.get_write_buffer_size() > self._settings.cluster.limit:
+                self.logger.warning("Dropping a worker that is lagging behind")
+                writer.close()
+                self._workers.discard(writer)
+                continue
+            writer.write(line)
+
+    def _query(self, message: dict) -> dict:
+        """
+        Answers a query of a worker.
+
+        Args:
+            message (dict): The id, name and arguments of the query.
+
+        Returns:
+            dict: The id of the query, the HTTP status and the answer.
+        """
+        handler = self._queries.get(message["name"])
+        if handler is None:
+            status, data = HTTP_404_NOT_FOUND, f"Unknown query {message['name']}"
+        else:
+            try:
+                status, data = handler(**message["args"])
+            except TypeError as e:
+                status, data = HTTP_400_BAD_REQUEST, f"Invalid query {message['name']}: {e}"
+        return {"id": message["id"], "status": status, "data": data}
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """
+        Handles a worker connection, sending it the current state first.
+
+        Args:
+            reader (asyncio.StreamReader): The stream of updates published by the worker.
+            writer (asyncio.StreamWriter): The stream of updates to the worker.
+        """
+        writer.write(f"settings {self._settings.model_dump_json(exclude={'source_file'})}\n".encode())
+        for name, publisher in self._publishers.items():
+            for topic, data in publisher.cached():
+                writer.write(f"{name} {encode(topic, data)}\n".encode())
+        self._workers.add(writer)
+
+        try:
+            while line := await reader.readline():
+                kind, _, payload = line.decode().rstrip("\n").partition(" ")
+                message = json.loads(payload)
+                if kind == "settings":
+                    self._settings.update(message)
+                    self._settings.persist()
+                    if self._on_settings is not None:
+                        await self._on_settings()
+                elif kind == "query":
+                    writer.write(f"reply {json.dumps(self._query(message))}\n".encode())
+                elif kind == "admin" and message["topic"] == "queue-stats":
+                    # Published with the next report of this process
+                    self._stats[writer] = message["data"]
+                elif kind == "admin" and message["topic"] == "active-connections":
+                    self._connections[writer] = message["data"]
+                    await self._publishers["admin"].relay(
+                        "active-connections", self._local_connections
+                    )
+                elif kind in self._publishers:
+                    await self._publishers[kind].relay(message["topic"], message["data"])
+        except (ConnectionError, ValueError, KeyError) as e:
+            self.logger.warning(f"Invalid message from worker: {e}")
+        finally:
+            self._workers.discard(writer)
+            self._connections.pop(writer, None)
+            self._stats.pop(writer, None)
+            writer.close()
+            await self._publishers["admin"].relay("active-connections", self._local_connections)
+
+
+class ClusterClient:
+    """
+    Runs in a worker process and applies the updates forwarded by the ingest process to the local publishers.
+
+    Updates published in the worker, e.g. by an admin action, are sent to the ingest process instead of being
+    applied locally, so every worker receives them in the same order.
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        feed_publisher: DataPublisher,
+        admin_publisher: DataPublisher,
+    ):
+        self._settings: Settings = settings
+        self._publishers: dict[str, DataPublisher] = {
+            "feed": feed_publisher,
+            "admin": admin_publisher,
+        }
+        self._writer: asyncio.StreamWriter | None = None
+        # Query id -> future of the reply of the ingest process
+        self._replies: dict[int, asyncio.Future] = {}
+        self._query_ids: int = 0
+        self.logger = logging.getLogger("uvicorn")
+
+        for name, publisher in self._publishers.items():
+            publisher.relay = self._relay(name)
+        settings.on_persist(self._send_settings)
+
+    def _relay(self, name: str):
+        async def relay(topic: str, data: JsonData):
+            self._send(f"{name} {encode(topic, data)}\n")
+
+        return relay
+
+    def _send_settings(self, settings: Settings):
+        self._send(f"settings {settings.model_dump_json(exclude={'source_file'})}\n")
+
+    def _send(self, line: str):
+        if self._writer is None:
+            self.logger.warning("Not connected to the ingest process, dropping update")
+            return
+        self._writer.write(line.encode())
+
+    async def query(self, name: str, **args) -> tuple[int, JsonData]:
+        """
+        Asks the ingest process to answer a query.
+
+        Args:
+            name (str): The name of the query.
+            **args: The arguments of the query.
+
+        Returns:
+            tuple: The HTTP status and the answer, 503 when the ingest process can't be reached.
+        """
+        if self._writer is None:
+            return HTTP_503_SERVICE_UNAVAILABLE, "Not connected to the ingest process"
+        self._query_ids += 1
+        query_id = self._query_ids
+        reply = asyncio.get_running_loop().create_future()
+        self._replies[query_id] = reply
+        self._send(f"query {json.dumps({'id': query_id, 'name': name, 'args': args})}\n")
+        try:
+            return await asyncio.wait_for(reply, self._settings.cluster.timeout)
+        except asyncio.TimeoutError:
+            return HTTP_503_SERVICE_UNAVAILABLE, "The ingest process didn't answer"
+        finally:
+            self._replies.pop(query_id, None)
+
+    async def start(self):
+        """
+        Connects to the ingest process and continuously applies the received updates.
+
+        If the connection is lost, it will attempt to reconnect.
+        """
+        while True:
+            try:
+                reader, self._writer = await asyncio.open_unix_connection(
+                    self._settings.cluster.socket, limit=self._settings.cluster.limit
+                )
+                while line := await reader.readline():
+                    kind, _, payload = line.decode().rstrip("\n").partition(" ")
+                    message = json.loads(payload)
+                    if kind == "settings":
+                        self._settings.update(message)
+                    elif kind == "reply":
+                        reply = self._replies.pop(message["id"], None)
+                        if reply is not None and not reply.done():
+                            reply.set_result((message["status"], message["data"]))
+                    elif kind in self._publishers:
+                        await self._publishers[kind].apply(message["topic"], message["data"])
+            except OSError as e:
+                self.logger.warning(f"Can't reach the ingest process: {e}")
+            finally:
+                if self._writer is not None:
+                    self._writer.close()
+                    self._writer = None
+                for reply in self._replies.values():
+                    if not reply.done():
+                        reply.set_result((HTTP_503_SERVICE_UNAVAILABLE, "Lost the connection to the ingest process"))
+                self._replies.clear()
+            await asyncio.sleep(self._settings.interval.websocket)
@@ -1,50 +1,180 @@
-from asyncio import Lock, Queue
-from typing import Any
+import random
+from asyncio import Lock
+from hashlib import blake2b
+from collections import Counter, defaultdict
+from itertools import chain
+from typing import Any, Awaitable, Callable, Iterable
 
+from src.encoding import DELTA_KEYS, JsonData, Update
+from src.history import PositionHistory
+from src.mailbox import Mailbox
+from src.models import FeedOptions
 from src.settings import Settings
 
-JsonData = str | int | float | dict | list
+# Topics that are delivered to every queue, regardless of its subscriptions
+CONTROL_TOPICS: set[str] = {"refresh"}
+
+# Amount of distinct delays a staggered refresh is spread over
+REFRESH_SLOTS: int = 32
+
+
+def refresh(window: int) -> dict | bool:
+    """
+    Returns the data to publish to the refresh topic.
+
+    Args:
+        window (int): The window in seconds clients reload within.
+
+    Returns:
+        dict | bool: A staggered refresh, or an immediate one when there is no window.
+    """
+    return {"window": window} if window > 0 else True
 
 
 class QueueManager:
     """
-    Manages a collection of queues and broadcast data to the queues.
+    Manages a collection of bounded queues and broadcast data to the queues.
+    Queues are indexed by the topics they subscribed to, queues without subscriptions receive every topic.
     """
 
-    def __init__(self) -> None:
-        self._queues: list[Queue] = list()
-        self._broadcast_lock: Lock = Lock()
+    def __init__(self, settings: Settings) -> None:
+        self._settings = settings
+        self._queues: list[Mailbox] = list()
+        self._subscribers: defaultdict[str | None, set[Mailbox]] = defaultdict(set)
+        # Position rate class -> queues of the class that receive positions
+        self._rate_members: defaultdict[int, set[Mailbox]] = defaultdict(set)
+        self._stats: Counter = Counter()
 
-    async def add(self) -> Queue:
+    async def add(self, options: FeedOptions = FeedOptions()) -> Mailbox:
         """
         Adds a new queue to the collection.
 
+        Args:
+            options (FeedOptions): The protocol mode, wire format and topics of the client.
+
         Returns:
-            Queue: The newly created queue.
+            Mailbox: The newly created queue.
         """
-        queue: Queue = Queue()
+        queue: Mailbox = Mailbox(self._settings.queue, self._stats, options)
+        queue.position_hz = self._rate_class(options.position_hz)
         self._queues.append(queue)
+        self._index(queue, options.topics)
         return queue
 
-    async def remove(self, queue: Queue):
+    def _rate_class(self, position_hz: int | None) -> int | None:
+        """
+        Selects the position rate class of a client.
+
+        Args:
+            position_hz (int | None): The requested rate, None for the default rate.
+
+        Returns:
+            int | None: The highest rate class not above the requested rate (the lowest class if all are),
+                None to receive every position update.
+        """
+        if position_hz is None:
+            position_hz = self._settings.positions.default
+        rates = self._settings.positions.rates
+        if position_hz is None or not rates:
+            return None
+        return max((rate for rate in rates if rate <= position_hz), default=min(rates))
+
+    async def remove(self, queue: Mailbox):
         """
         Removes a queue from the collection.
 
         Args:
-            queue (Queue): The queue to be removed.
+            queue (Mailbox): The queue to be removed.
         """
         self._queues.remove(queue)
+        self._unindex(queue)
+        queue.removed = True
+
+    async def subscribe(self, queue: Mailbox, topics: Iterable[str] | None):
+        """
+        Replaces the topics a queue subscribes to.
+
+        Args:
+            queue (Mailbox): The queue.
+            topics (Iterable[str] | None): The topics to subscribe to, None for all topics.
+        """
+        self._unindex(queue)
+        self._index(queue, topics)
+
+    def _index(self, queue: Mailbox, topics: Iterable[str] | None):
+        queue.topics = frozenset(topics) if topics is not None else None
+        for topic in queue.topics if queue.topics is not None else (None,):
+            self._subscribers[topic].add(queue)
+        if queue.position_hz is not None and (queue.topics is None or "position" in queue.topics):
+            self._rate_members[queue.position_hz].add(queue)
+
+    def _unindex(self, queue: Mailbox):
+        for topic in queue.topics if queue.topics is not None else (None,):
+            self._subscribers[topic].discard(queue)
+            if not self._subscribers[topic]:
+                del self._subscribers[topic]
+        if queue.position_hz is not None:
+            self._rate_members[queue.position_hz].discard(queue)
+            if not self._rate_members[queue.position_hz]:
+                del self._rate_members[queue.position_hz]
+
+    def _has_subscribers(self, topic: str) -> bool:
+        """
+        Checks whether any queue receives the given topic.
+
+        Args:
+            topic (str): The topic.
+
+        Returns:
+            bool: Whether the topic has subscribers.
+        """
+        return topic in CONTROL_TOPICS or None in self._subscribers or topic in self._subscribers
+
+    async def _broadcast(self, update: Update):
+        """
+        Broadcasts the given update to all queues subscribed to its topic.
+        Each wire variant of the update is only encoded once, no matter how many queues receive it.
+        Queues never block, a full queue applies its overflow policy instead.
+
+        Args:
+            update (Update): The update to be broadcasted.
+        """
+        if update.topic in CONTROL_TOPICS:
+            queues = self._queues
+        else:
+            queues = self._recipients(update.topic)
+        for queue in queues:
+            # Queues in a position rate class only receive the batched position ticks
+            if update.topic != "position" or queue.position_hz is None:
+                queue.put(update)
+
+    def _recipients(self, topic: str) -> Iterable[Mailbox]:
+        """
+        Returns the queues subscribed to a topic.
+
+        Args:
+            topic (str): The topic.
 
-    async def _broadcast(self, data: tuple[str, JsonData]):
+        Returns:
+            Iterable: The queues.
+        """
+        return chain(self._subscribers.get(None, ()), self._subscribers.get(topic, ()))
+
+    async def _broadcast_staggered(self, topic: str, window: float):
         """
-        Broadcasts the given data to all queues in the collection.
+        Broadcasts a refresh to all queues, assigning each queue a random delay within the window.
+        The delays are spread over a fixed amount of slots, so only one frame per slot is encoded.
 
         Args:
-            data (tuple): The data to be broadcasted.
+            topic (str): The topic of the refresh.
+            window (float): The window in seconds.
         """
-        async with self._broadcast_lock:
-            for queue in self._queues:
-                await queue.put(data)
+        slots = [
+            Update(topic, {"delay": round(window * 1000 * slot / (REFRESH_SLOTS - 1))})
+            for slot in range(REFRESH_SLOTS)
+        ]
+        for queue in self._queues:
+            queue.put(random.choice(slots))
 
     async def count(self) -> int:
         """
@@ -55,49 +185,301 @@ class QueueManager:
         """
         return len(self._queues)
 
+    async def stats(self) -> dict[str, int]:
+        """
+        Returns the overflow policy counters and the current queue usage.
+
+        Returns:
+            dict: The counters.
+        """
+        return {
+            "queues": len(self._queues),
+            "pending": sum(len(queue) for queue in self._queues),
+            "dropped": self._stats["dropped"],
+            "coalesced": self._stats["coalesced"],
+            "conflated": self._stats["conflated"],
+            "disconnected": self._stats["disconnected"],
+        }
+
+    def rate_classes(self) -> set[int]:
+        """
+        Returns the position rate classes that queues are a member of.
+
+        Returns:
+            set: The rates in Hz.
+        """
+        return set(self._rate_members)
+
+
+class _RateClass:
+    """
+    The position updates of a rate class since its last tick.
+    """
+
+    __slots__ = ("pending", "snapshot", "position_source")
+
+    def __init__(self) -> None:
+        self.pending: dict[int, dict] = {}  # Team id -> newest position since the last tick
+        self.snapshot: Update | None = None  # Versioned positions as of the last tick
+        self.position_source: str | None = None  # Position source of the snapshot
+
 
 class DataPublisher(QueueManager):
     """
     An extension on QueueManagers that only publishes data when it is different from last publish.
     Also provides a way to publish data to topics. This way one queue can easily be used for multiple data updates.
+    Updates of the counts and position topics are versioned, so delta clients only receive the changed teams.
+    Publishing `{"window": <seconds>}` to the refresh topic tells every client to reload after a random delay
+    within the window, sent as `{"delay": <milliseconds>}`.
+    Position updates of queues in a rate class are merged per team and sent on every tick of the class,
+    encoded once per class instead of once per upstream message.
+    The recent positions of every team are kept, so new clients can draw trails without waiting for them.
+    The cached data is also served as a pre-encoded HTTP body, encoded once until a topic changes.
     """
 
     def __init__(self, settings: Settings) -> None:
-        super().__init__()
-        self._settings = settings
+        super().__init__(settings)
         self._cache: dict[str, Any] = dict()
         self._cache["position"] = {}
+        self._versions: Counter = Counter()
+        # Snapshot updates of the cached data, shared by every new queue until the topic is published again
+        self._snapshots: dict[str, Update] = dict()
+        self._snapshot_position_source: str | None = None
         self._publish_lock: Lock = Lock()
+        self._rate_classes: defaultdict[int, _RateClass] = defaultdict(_RateClass)
+        self._history: PositionHistory = PositionHistory(settings.positions.history)
+        # History update of the active position source, shared by every queue until a position is published
+        self._history_burst: Update | None = None
+        # Topics -> encoded body of the cached data and its ETag
+        self._bodies: dict[frozenset[str] | None, tuple[bytes, str]] = dict()
+        self._bodies_position_source: str | None = None
+        # When set, publishes are handed to the relay instead of being applied directly (see src.cluster)
+        self.relay: Callable[[str, JsonData], Awaitable[None]] | None = None
 
-    async def add(self) -> Queue:
+    async def add(self, options: FeedOptions = FeedOptions()) -> Mailbox:
         """
         Adds a new queue and publishes cached data to the new queue.
 
+        The cached data is published as snapshot updates that are shared by all new queues, so each topic
+        is only encoded once per publish no matter how many clients connect. Putting never awaits,
+        so no lock is needed to keep the snapshot consistent with the broadcasts.
+
+        Args:
+            options (FeedOptions): The protocol mode, wire format and topics of the client.
+
         Returns:
-            Queue: The newly created queue.
+            Mailbox: The newly created queue.
 
         """
-        queue: Queue = await super().add()
-        async with self._publish_lock:
-            # Publish cached data to the new queue
-            # Add the position data last
-            for topic in self._cache:
-                if topic != "position":
-                    await queue.put((topic, self._cache[topic]))
-
-            position_data = []
-            if self._settings.position_source.name in self._cache["position"]:
-                position_data = [
-                    self._cache["position"][self._settings.position_source.name][
-                        team_id
-                    ]
-                    for team_id in self._cache["position"][
-                        self._settings.position_source.name
-                    ]
-                ]
-            await queue.put(("position", position_data))
+        queue: Mailbox = await super().add(options)
+        self._put_cached(queue, queue.topics)
+        if options.history:
+            await self.history(queue)
         return queue
 
+    async def subscribe(self, queue: Mailbox, topics: Iterable[str] | None):
+        """
+        Replaces the topics a queue subscribes to and publishes the cached data of the new topics.
+
+        Args:
+            queue (Mailbox): The queue.
+            topics (Iterable[str] | None): The topics to subscribe to, None for all topics.
+        """
+        previous = queue.topics
+        await super().subscribe(queue, topics)
+        if previous is not None:
+            self._put_cached(queue, queue.topics, previous)
+
+    def _put_cached(
+        self,
+        queue: Mailbox,
+        topics: frozenset[str] | None,
+        exclude: frozenset[str] = frozenset(),
+    ):
+        """
+        Publishes the cached data of the given topics to a queue.
+
+        Args:
+            queue (Mailbox): The queue.
+            topics (frozenset[str] | None): The topics to publish, None for all topics.
+            exclude (frozenset[str]): The topics the queue already received.
+        """
+        # Add the position data last
+        for topic in sorted(self._cache, key=lambda topic: topic == "position"):
+            if (topics is None or topic in topics) and topic not in exclude:
+                queue.put(self._queue_snapshot(queue, topic))
+
+    async def resync(self, queue: Mailbox, topic: str):
+        """
+        Sends a versioned snapshot of a delta topic to a queue that missed a delta.
+
+        Args:
+            queue (Mailbox): The queue to resync.
+            topic (str): The topic to resync.
+        """
+        if topic not in DELTA_KEYS or topic not in self._cache:
+            return
+        queue.put(self._queue_snapshot(queue, topic))
+
+    async def history(self, queue: Mailbox):
+        """
+        Sends the recent positions of the active position source to a queue that receives positions.
+
+        Args:
+            queue (Mailbox): The queue.
+        """
+        if queue.topics is not None and "position" not in queue.topics:
+            return
+        position_source = self._settings.position_source.name
+        if self._history_burst is None or self._history_burst.data["positioner"] != position_source:
+            self._history_burst = Update("history", self._history.burst(position_source))
+        queue.put(self._history_burst)
+
+    def _queue_snapshot(self, queue: Mailbox, topic: str) -> Update:
+        """
+        Returns the snapshot update of a topic for a queue.
+        Queues in a position rate class get the positions as of the last tick of their class,
+        so the next tick applies to the snapshot version.
+
+        Args:
+            queue (Mailbox): The queue.
+            topic (str): The topic.
+
+        Returns:
+            Update: The snapshot update.
+        """
+        if topic != "position" or queue.position_hz is None:
+            return self._snapshot(topic)
+
+        rate_class = self._rate_classes[queue.position_hz]
+        if rate_class.snapshot is None:
+            rate_class.snapshot = self._snapshot(topic)
+            rate_class.position_source = self._snapshot_position_source
+        return rate_class.snapshot
+
+    async def tick(self, position_hz: int):
+        """
+        Sends the position updates since the previous tick to the queues of a rate class.
+
+        Args:
+            position_hz (int): The rate class.
+        """
+        rate_class = self._rate_classes[position_hz]
+        queues = self._rate_members.get(position_hz)
+        if not queues:
+            # Nobody tracks the positions of this class, start over from a new snapshot when a queue joins
+            self._rate_classes.pop(position_hz, None)
+            return
+        if rate_class.snapshot is None:
+            return
+
+        if rate_class.position_source != self._settings.position_source.name:
+            # The position source changed, send the positions of the new source
+            rate_class.pending = {}
+            rate_class.snapshot = self._snapshot("position")
+            rate_class.position_source = self._snapshot_position_source
+            update = rate_class.snapshot
+        elif rate_class.pending:
+            changed = list(rate_class.pending.values())
+            rate_class.pending = {}
+            version = self._versions["position"]
+            positions = list(self._cache["position"].get(rate_class.position_source, {}).values())
+            update = Update("position", changed, version, rate_class.snapshot.version, changed, [])
+            rate_class.snapshot = Update("position", positions, version, snapshot=True)
+        else:
+            return
+
+        for queue in queues:
+            queue.put(update)
+
+    def _snapshot(self, topic: str) -> Update:
+        """
+        Returns the snapshot update of the cached data of a topic, creating it if it was invalidated.
+
+        Args:
+            topic (str): The topic.
+
+        Returns:
+            Update: The snapshot update.
+        """
+        if topic == "position" and self._snapshot_position_source != self._settings.position_source.name:
+            self._snapshots.pop("position", None)
+
+        snapshot = self._snapshots.get(topic)
+        if snapshot is not None:
+            return snapshot
+
+        if topic != "position":
+            snapshot = Update(topic, self._cache[topic], self._versions[topic], snapshot=True)
+        else:
+            self._snapshot_position_source = self._settings.position_source.name
+            position_data = list(
+                self._cache["position"].get(self._snapshot_position_source, {}).values()
+            )
+            snapshot = Update("position", position_data, self._versions["position"], snapshot=True)
+        self._snapshots[topic] = snapshot
+        return snapshot
+
+    def body(self, topics: frozenset[str] | None = None) -> tuple[bytes, str]:
+        """
+        Returns the cached data as one JSON document, the list of messages a new feed client receives.
+        The body reuses the encoded snapshot frames and is cached until one of its topics changes.
+
+        Args:
+            topics (frozenset[str] | None): The topics to include, None for all topics.
+
+        Returns:
+            tuple: The encoded body and its ETag.
+        """
+        if self._bodies_position_source != self._settings.position_source.name:
+            self._bodies.clear()
+            self._bodies_position_source = self._settings.position_source.name
+        cached = self._bodies.get(topics)
+        if cached is not None:
+            return cached
+
+        frames = [
+            self._snapshot(topic).frame()
+            for topic in sorted(self._cache, key=lambda topic: topic == "position")
+            if topics is None or topic in topics
+        ]
+        body = f"[{','.join(frames)}]".encode()
+        etag = f'"{blake2b(body, digest_size=16).hexdigest()}"'
+        self._bodies[topics] = (body, etag)
+        return body, etag
+
+    def _update(self, topic: str, data: JsonData, changed: list[dict] | None, removed: list[int]) -> Update:
+        """
+        Creates a new version of a topic update, including its delta for delta topics.
+
+        Args:
+            topic (str): The topic.
+            data (JsonData): The published data.
+            changed (list | None): The changed team entries, None if nobody receives the delta.
+            removed (list): The keys of the removed team entries.
+
+        Returns:
+            Update: The update.
+        """
+        if topic not in DELTA_KEYS or (changed is not None and not (changed or removed)):
+            return Update(topic, data)
+        base = self._versions[topic]
+        self._versions[topic] += 1
+        return Update(topic, data, self._versions[topic], base, changed, removed)
+
+    def cached(self) -> Iterable[tuple[str, JsonData]]:
+        """
+        Returns the publishes that reproduce the cached data.
+
+        Returns:
+            Iterable: The (topic, data) pairs.
+        """
+        for topic, data in self._cache.items():
+            if topic != "position":
+                yield topic, data
+        for position_source, positions in self._cache["position"].items():
+            yield "position", {"positioner": position_source, "positions": list(positions.values())}
+
     async def publish(self, topic: str, data: JsonData):
         """
         Publishes data to a specific topic.
@@ -106,23 +488,73 @@ class DataPublisher(QueueManager):
             topic (str): The topic to publish the data to.
             data (JsonData): The data to be published.
         """
+        if self.relay is not None:
+            await self.relay(topic, data)
+        else:
+            await self.apply(topic, data)
+
+    async def apply(self, topic: str, data: JsonData) -> bool:
+        """
+        Applies published data to the cache and broadcasts it when it changed.
+
+        Args:
+            topic (str): The topic to publish the data to.
+            data (JsonData): The data to be published.
+
+        Returns:
+            bool: Whether the data changed.
+        """
         async with self._publish_lock:
             if topic == "position":
                 position_source = data["positioner"]
                 if position_source not in self._cache[topic]:
                     self._cache[topic][position_source] = {}
 
-                for team_data in data["positions"]:
-                    self._cache[topic][position_source][team_data["team_id"]] = (
+                cached = self._cache[topic][position_source]
+                active = position_source == self._settings.position_source.name
+                changed = None
+                if active and self._has_subscribers(topic):
+                    changed = [
                         team_data
-                    )
+                        for team_data in data["positions"]
+                        if cached.get(team_data["team_id"]) != team_data
+                    ]
+                for team_data in data["positions"]:
+                    cached[team_data["team_id"]] = team_data
+                self._history.record(position_source, data["positions"])
+                if self._history_burst is not None and self._history_burst.data["positioner"] == position_source:
+                    self._history_burst = None
 
-                if position_source == self._settings.position_source.name:
-                    await self._broadcast((topic, data["positions"]))
-                return
+                if position_source == self._snapshot_position_source:
+                    self._snapshots.pop(topic, None)
+                    self._bodies.clear()
+                if active and changed:
+                    for rate_class in self._rate_classes.values():
+                        if rate_class.snapshot is not None:
+                            for team_data in changed:
+                                rate_class.pending[team_data["team_id"]] = team_data
+                if active:
+                    await self._broadcast(self._update(topic, data["positions"], changed, []))
+                return True
 
             if topic in self._cache and self._cache[topic] == data:
-                return
+                return False
+
+            if topic == "refresh" and isinstance(data, dict) and data.get("window"):
+                await self._broadcast_staggered(topic, data["window"])
+                return True
+
+            changed, removed = None, []
+            if topic in DELTA_KEYS and self._has_subscribers(topic):
+                key = DELTA_KEYS[topic]
+                previous = {key(entry): entry for entry in self._cache.get(topic, [])}
+                changed = [entry for entry in data if previous.get(key(entry)) != entry]
+                current = {key(entry) for entry in data}
+                removed = [team for team in previous if team not in current]
+
             if topic != "refresh":
                 self._cache[topic] = data
-            await self._broadcast((topic, data))
+                self._snapshots.pop(topic, None)
+                self._bodies.clear()
+            await self._broadcast(self._update(topic, data, changed, removed))
+            return True
@@ -1,21 +1,36 @@
 from starlette.templating import Jinja2Templates
 
+from src.cluster import ClusterClient, get_role
 from src.data_publisher import DataPublisher
 from src.settings import Settings
+from src.sse import EventStreamHandler
 from src.websocket import WebSocketHandler, ConnectionTracker
 from src.storeman import Storeman
+from src.tasks.fetcher import Fetcher
+from src.telraam import TelraamClient
+from src.tasks.heartbeat import Heartbeat
 
 _settings = Settings.load_from_yaml("config.yml")
 
 _feed_publisher = DataPublisher(_settings)
 _admin_publisher = DataPublisher(_settings)
 
-_storeman = Storeman(_feed_publisher)
+_storeman = Storeman(_settings, _feed_publisher)
+
+_telraam_client = TelraamClient(_settings, _admin_publisher)
+
+_fetcher = Fetcher(_settings, _feed_publisher, _admin_publisher, _storeman, _telraam_client)
 
 _connection_tracker = ConnectionTracker(_admin_publisher)
 
-_feed_handler = WebSocketHandler(_settings, _feed_publisher, _connection_tracker)
-_admin_feed_handler = WebSocketHandler(_settings, _admin_publisher, _connection_tracker)
+_heartbeat = Heartbeat(_settings, _feed_publisher, _admin_publisher)
+
+_feed_handler = WebSocketHandler(_settings, _feed_publisher, _connection_tracker, _heartbeat)
+_admin_feed_handler = WebSocketHandler(_settings, _admin_publisher, _connection_tracker, _heartbeat)
+_event_stream_handler = EventStreamHandler(_feed_publisher, _connection_tracker, _heartbeat)
+
+# Only workers are connected to an ingest process
+_cluster_client = ClusterClient(_settings, _feed_publisher, _admin_publisher) if get_role() == "worker" else None
 
 _templates = Jinja2Templates(directory="templates")
 
@@ -31,6 +46,11 @@ async def get_feed_publisher() -> DataPublisher:
 async def get_feed_handler() -> WebSocketHandler:
     return _feed_handler
 
+
+async def get_event_stream_handler() -> EventStreamHandler:
+    return _event_stream_handler
+
+
 async def get_storeman() -> Storeman:
     return _storeman
 
@@ -47,5 +67,21 @@ async def get_connection_tracker() -> ConnectionTracker:
     return _connection_tracker
 
 
+async def get_telraam_client() -> TelraamClient:
+    return _telraam_client
+
+
+async def get_fetcher() -> Fetcher:
+    return _fetcher
+
+
+async def get_heartbeat() -> Heartbeat:
+    return _heartbeat
+
+
+async def get_cluster_client() -> ClusterClient | None:
+    return _cluster_client
+
+
 async def get_templates() -> Jinja2Templates:
     return _templates
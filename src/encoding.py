@@ -0,0 +1,183 @@
+import json
+from typing import Callable
+
+from fastapi.encoders import jsonable_encoder
+
+try:
+    import msgpack
+except ImportError:  # msgpack is an optional dependency, the msgpack format is unavailable without it
+    msgpack = None
+
+JsonData = str | int | float | dict | list
+Frame = str | bytes
+
+# Wire formats a client can negotiate
+#   json: JSON text frames, the default
+#   columnar: JSON text frames with team entries laid out as columns
+#   msgpack: MessagePack binary frames with team entries laid out as columns
+FORMATS: tuple[str, ...] = ("json", "columnar") + (("msgpack",) if msgpack else ())
+
+# Topics that support the delta protocol, mapped to the key identifying a team entry
+DELTA_KEYS: dict[str, Callable[[dict], int]] = {
+    "counts": lambda count: count["team"]["id"],
+    "position": lambda position: position["team_id"],
+}
+
+
+def columns(entries: list[dict]) -> dict[str, list]:
+    """
+    Lays out a list of team entries as columns, so the keys are only sent once.
+    Nested objects are flattened, e.g. `{"team": {"id": 1}}` becomes the `team_id` column.
+
+    Args:
+        entries (list): The team entries.
+
+    Returns:
+        dict: The columns, mapping each key to the values of all entries.
+    """
+
+    def _flatten(entry: dict, prefix: str = "") -> dict:
+        flat = {}
+        for key, value in entry.items():
+            if isinstance(value, dict):
+                flat.update(_flatten(value, f"{prefix}{key}_"))
+            else:
+                flat[f"{prefix}{key}"] = value
+        return flat
+
+    rows = [_flatten(entry) for entry in entries]
+    keys = dict.fromkeys(key for row in rows for key in row)
+    return {key: [row.get(key) for row in rows] for key in keys}
+
+
+def _serialize(topic: str, message: dict, fmt: str) -> Frame:
+    if fmt != "json" and topic in DELTA_KEYS:
+        for field in ("data", "delta"):
+            if isinstance(message.get(field), list):
+                message[field] = columns(message[field])
+
+    message = jsonable_encoder(message)
+    if fmt == "msgpack":
+        return msgpack.packb(message)
+    return json.dumps(message, separators=(",", ":"), ensure_ascii=False)
+
+
+def encode(topic: str, data: JsonData, version: int | None = None, fmt: str = "json") -> Frame:
+    """
+    Serializes a topic update into a websocket frame.
+
+    Args:
+        topic (str): The topic of the update.
+        data (JsonData): The data of the update.
+        version (int | None): The version of the data, only sent to delta clients.
+        fmt (str): The wire format.
+
+    Returns:
+        Frame: The encoded frame.
+    """
+    if version is None:
+        return _serialize(topic, {"topic": topic, "data": data}, fmt)
+    return _serialize(topic, {"topic": topic, "version": version, "data": data}, fmt)
+
+
+def encode_delta(
+    topic: str,
+    version: int,
+    base: int,
+    delta: list[dict],
+    removed: list[int],
+    fmt: str = "json",
+) -> Frame:
+    """
+    Serializes the changed team entries of a topic into a websocket frame.
+
+    Args:
+        topic (str): The topic of the update.
+        version (int): The version after applying the delta.
+        base (int): The version the delta applies to.
+        delta (list): The changed team entries.
+        removed (list): The keys of the removed team entries.
+        fmt (str): The wire format.
+
+    Returns:
+        Frame: The encoded frame.
+    """
+    return _serialize(
+        topic,
+        {
+            "topic": topic,
+            "version": version,
+            "base": base,
+            "delta": delta,
+            "removed": removed,
+        },
+        fmt,
+    )
+
+
+def encode_ping(fmt: str = "json") -> Frame:
+    """
+    Serializes a keep-alive ping into a websocket frame.
+
+    Args:
+        fmt (str): The wire format.
+
+    Returns:
+        Frame: The encoded frame.
+    """
+    return _serialize("ping", {"ping": "pong"}, fmt)
+
+
+class Update:
+    """
+    A published topic update.
+
+    Every wire variant of the update is encoded at most once per format and the frame is shared by every client.
+    The variants are:
+        full: The data of the update.
+        snapshot: The data of the update, with its version.
+        delta: Only the team entries that changed since the previous version.
+    """
+
+    __slots__ = ("topic", "data", "version", "base", "delta", "removed", "snapshot", "_frames")
+
+    def __init__(
+        self,
+        topic: str,
+        data: JsonData,
+        version: int | None = None,
+        base: int | None = None,
+        delta: list[dict] | None = None,
+        removed: list[int] | None = None,
+        snapshot: bool = False,
+    ):
+        self.topic: str = topic
+        self.data: JsonData = data
+        self.version: int | None = version
+        self.base: int | None = base
+        self.delta: list[dict] | None = delta
+        self.removed: list[int] = removed or []
+        self.snapshot: bool = snapshot
+        self._frames: dict[tuple[str, str], Frame] = {}
+
+    def frame(self, variant: str = "full", fmt: str = "json") -> Frame:
+        """
+        Returns the encoded variant of the update, encoding it on first use.
+
+        Args:
+            variant (str): The wire variant.
+            fmt (str): The wire format.
+
+        Returns:
+            Frame: The encoded frame.
+        """
+        frame = self._frames.get((variant, fmt))
+        if frame is None:
+            if variant == "delta":
+                frame = encode_delta(self.topic, self.version, self.base, self.delta, self.removed, fmt)
+            elif variant == "snapshot":
+                frame = encode(self.topic, self.data, self.version, fmt)
+            else:
+                frame = encode(self.topic, self.data, fmt=fmt)
+            self._frames[(variant, fmt)] = frame
+        return frame
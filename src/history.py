@@ -0,0 +1,127 @@
+import time
+from array import array
+
+
+class _Ring:
+    """
+    The most recent position samples of a team, in fixed-size array-backed columns.
+    """
+
+    __slots__ = ("timestamp", "progress", "speed", "acceleration", "start", "length")
+
+    def __init__(self, size: int):
+        self.timestamp: array = array("q", bytes(8 * size))
+        self.progress: array = array("d", bytes(8 * size))
+        self.speed: array = array("d", bytes(8 * size))
+        self.acceleration: array = array("d", bytes(8 * size))
+        self.start: int = 0  # Index of the oldest sample
+        self.length: int = 0  # Amount of samples, at most the size
+
+    def append(self, timestamp: int, progress: float, speed: float, acceleration: float):
+        """
+        Appends a sample, overwriting the oldest one when the ring is full.
+
+        Args:
+            timestamp (int): The timestamp of the sample in milliseconds.
+            progress (float): The progress of the team.
+            speed (float): The speed of the team.
+            acceleration (float): The acceleration of the team.
+        """
+        size = len(self.timestamp)
+        if self.length < size:
+            index = (self.start + self.length) % size
+            self.length += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % size
+        self.timestamp[index] = timestamp
+        self.progress[index] = progress
+        self.speed[index] = speed
+        self.acceleration[index] = acceleration
+
+    def last_timestamp(self) -> int | None:
+        if not self.length:
+            return None
+        return self.timestamp[(self.start + self.length - 1) % len(self.timestamp)]
+
+    def columns(self) -> dict[str, list]:
+        """
+        Returns the samples as columns, oldest first.
+
+        Returns:
+            dict: The timestamp, progress, speed and acceleration columns.
+        """
+        end = self.start + self.length
+        size = len(self.timestamp)
+
+        def _ordered(column: array) -> list:
+            if end <= size:
+                return column[self.start:end].tolist()
+            return column[self.start:].tolist() + column[:end - size].tolist()
+
+        return {
+            "timestamp": _ordered(self.timestamp),
+            "progress": _ordered(self.progress),
+            "speed": _ordered(self.speed),
+            "acceleration": _ordered(self.acceleration),
+        }
+
+
+class PositionHistory:
+    """
+    Recent position samples of every team, per position source.
+
+    Every team keeps a ring buffer of the last `size` samples, so the memory use is fixed at
+    32 bytes per sample, no matter how long Loxsi runs. Samples that are not newer than the last
+    sample of the team, such as repeated upstream messages, are skipped.
+    """
+
+    def __init__(self, size: int):
+        self._size: int = size
+        # Position source -> team id -> samples
+        self._rings: dict[str, dict[int, _Ring]] = dict()
+
+    def record(self, position_source: str, positions: list[dict]):
+        """
+        Records the positions of an upstream message.
+
+        Args:
+            position_source (str): The position source of the message.
+            positions (list): The positions of the teams.
+        """
+        if self._size <= 0:
+            return
+        rings = self._rings.setdefault(position_source, {})
+        now = int(time.time() * 1000)
+        for position in positions:
+            ring = rings.get(position["team_id"])
+            if ring is None:
+                ring = rings[position["team_id"]] = _Ring(self._size)
+            timestamp = position.get("timestamp") or now
+            last = ring.last_timestamp()
+            if last is not None and timestamp <= last:
+                continue
+            ring.append(
+                timestamp,
+                position.get("progress") or 0.0,
+                position.get("speed") or 0.0,
+                position.get("acceleration") or 0.0,
+            )
+
+    def burst(self, position_source: str) -> dict:
+        """
+        Returns the recent positions of every team of a position source.
+
+        Args:
+            position_source (str): The position source.
+
+        Returns:
+            dict: The position source and per team the samples as columns, oldest first.
+        """
+        return {
+            "positioner": position_source,
+            "teams": [
+                {"team_id": team_id, **ring.columns()}
+                for team_id, ring in self._rings.get(position_source, {}).items()
+            ],
+        }
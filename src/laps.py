@@ -0,0 +1,230 @@
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter
+from typing import NamedTuple
+
+
+class LapColumns(NamedTuple):
+    """
+    The fields of a list of laps that Loxsi uses, as columns
+    """
+
+    id: array
+    team_id: array
+    lap_source_id: array
+    timestamp: array
+
+    @classmethod
+    def empty(cls) -> "LapColumns":
+        return cls(array("q"), array("q"), array("q"), array("q"))
+
+    def append(self, lap: dict):
+        """
+        Appends a lap as returned by Telraam.
+
+        Args:
+            lap (dict): The lap.
+        """
+        self.id.append(lap["id"])
+        self.team_id.append(lap["teamId"])
+        self.lap_source_id.append(lap["lapSourceId"])
+        self.timestamp.append(lap["timestamp"])
+
+
+class LapStore:
+    """
+    Local copy of the laps of a Telraam lap endpoint, stored as columns.
+
+    The id, team_id, lap_source_id and timestamp columns are array-backed and sorted by timestamp.
+    Next to the columns, the timestamps of every lap source and team combination are kept sorted, so the lap
+    count of a team up to any timestamp is a binary search instead of a scan over all laps.
+
+    Laps are keyed by id, so fetching laps that are already known is harmless.
+    """
+
+    def __init__(self) -> None:
+        # Columns, sorted by timestamp
+        self.id: array = array("q")
+        self.team_id: array = array("q")
+        self.lap_source_id: array = array("q")
+        self.timestamp: array = array("q")
+
+        # Lap ids and their timestamps, sorted by id, to look up known laps
+        self._ids: array = array("q")
+        self._id_timestamps: array = array("q")
+
+        # (lap source id, team id) -> sorted timestamps of the laps
+        self._index: dict[tuple[int, int], array] = dict()
+
+    def __len__(self) -> int:
+        return len(self.id)
+
+    @property
+    def cursor(self) -> int | None:
+        """
+        Returns the highest known lap id.
+
+        Returns:
+            int | None: The lap id, None if the store is empty.
+        """
+        return self._ids[-1] if self._ids else None
+
+    def _row(self, lap_id: int, timestamp: int) -> int:
+        # Position of a lap in the columns
+        row = bisect_left(self.timestamp, timestamp)
+        while self.id[row] != lap_id:
+            row += 1
+        return row
+
+    def _insert(self, lap_id: int, team_id: int, lap_source_id: int, timestamp: int):
+        row = bisect_right(self.timestamp, timestamp)
+        if row == len(self.timestamp):
+            # New laps are almost always the latest
+            self.id.append(lap_id)
+            self.team_id.append(team_id)
+            self.lap_source_id.append(lap_source_id)
+            self.timestamp.append(timestamp)
+        else:
+            self.id.insert(row, lap_id)
+            self.team_id.insert(row, team_id)
+            self.lap_source_id.insert(row, lap_source_id)
+            self.timestamp.insert(row, timestamp)
+
+        index = self._index.setdefault((lap_source_id, team_id), array("q"))
+        insort(index, timestamp)
+
+        position = bisect_left(self._ids, lap_id)
+        self._ids.insert(position, lap_id)
+        self._id_timestamps.insert(position, timestamp)
+
+    def _delete(self, position: int):
+        timestamp = self._id_timestamps[position]
+        row = self._row(self._ids[position], timestamp)
+
+        index = self._index[(self.lap_source_id[row], self.team_id[row])]
+        del index[bisect_left(index, timestamp)]
+
+        for column in (self.id, self.team_id, self.lap_source_id, self.timestamp):
+            del column[row]
+        del self._ids[position]
+        del self._id_timestamps[position]
+
+    def add(self, lap_id: int, team_id: int, lap_source_id: int, timestamp: int) -> bool:
+        """
+        Adds a new or updated lap to the store.
+
+        Args:
+            lap_id (int): The id of the lap.
+            team_id (int): The id of the team.
+            lap_source_id (int): The id of the lap source.
+            timestamp (int): The timestamp of the lap.
+
+        Returns:
+            bool: Whether the store changed.
+        """
+        position = bisect_left(self._ids, lap_id)
+        if position < len(self._ids) and self._ids[position] == lap_id:
+            row = self._row(lap_id, self._id_timestamps[position])
+            if (
+                self.team_id[row] == team_id
+                and self.lap_source_id[row] == lap_source_id
+                and self.timestamp[row] == timestamp
+            ):
+                return False
+            self._delete(position)
+
+        self._insert(lap_id, team_id, lap_source_id, timestamp)
+        return True
+
+    def extend(self, laps: LapColumns) -> bool:
+        """
+        Adds new or updated laps to the store.
+
+        Args:
+            laps (LapColumns): The laps.
+
+        Returns:
+            bool: Whether the store changed.
+        """
+        changed = False
+        for lap_id, team_id, lap_source_id, timestamp in zip(*laps):
+            changed |= self.add(lap_id, team_id, lap_source_id, timestamp)
+        return changed
+
+    def replace(self, laps: LapColumns) -> bool:
+        """
+        Replaces all laps in the store, dropping the laps that no longer exist.
+
+        Args:
+            laps (LapColumns): All laps.
+
+        Returns:
+            bool: Whether the store changed.
+        """
+        previous = (self.id, self.team_id, self.lap_source_id, self.timestamp)
+
+        if _is_sorted(laps.timestamp) and _is_sorted(laps.id, strict=True):
+            # Telraam returns the laps ordered, so the columns can be used as they are
+            self.id, self.team_id, self.lap_source_id, self.timestamp = laps
+            self._ids, self._id_timestamps = array("q", laps.id), array("q", laps.timestamp)
+        else:
+            rows = sorted({row[1]: row for row in zip(laps.timestamp, *laps[:3])}.values())
+            self.timestamp = array("q", (row[0] for row in rows))
+            self.id = array("q", (row[1] for row in rows))
+            self.team_id = array("q", (row[2] for row in rows))
+            self.lap_source_id = array("q", (row[3] for row in rows))
+            by_id = sorted(zip(self.id, self.timestamp))
+            self._ids = array("q", (lap_id for lap_id, _ in by_id))
+            self._id_timestamps = array("q", (timestamp for _, timestamp in by_id))
+
+        self._index = dict()
+        for timestamp, team_id, lap_source_id in zip(self.timestamp, self.team_id, self.lap_source_id):
+            # The columns are sorted by timestamp, so appending keeps the index sorted
+            index = self._index.get((lap_source_id, team_id))
+            if index is None:
+                index = self._index[(lap_source_id, team_id)] = array("q")
+            index.append(timestamp)
+
+        return previous != (self.id, self.team_id, self.lap_source_id, self.timestamp)
+
+    def counts(self, lap_source_id: int | None = None, until: int | None = None) -> Counter[int]:
+        """
+        Counts the laps per team.
+
+        Args:
+            lap_source_id (int | None): Only count laps of this lap source, None for all lap sources.
+            until (int | None): Only count laps up to this timestamp, None for all laps.
+
+        Returns:
+            Counter: The amount of laps per team id.
+        """
+        counts: Counter[int] = Counter()
+        for (source, team), timestamps in self._index.items():
+            if lap_source_id is None or source == lap_source_id:
+                counts[team] += len(timestamps) if until is None else bisect_right(timestamps, until)
+        return counts
+
+    def has_laps_after(self, lap_source_id: int | None, timestamp: int) -> bool:
+        """
+        Checks whether there are laps after the given timestamp.
+
+        Args:
+            lap_source_id (int | None): Only check laps of this lap source, None for all lap sources.
+            timestamp (int): The timestamp.
+
+        Returns:
+            bool: Whether there are later laps.
+        """
+        if lap_source_id is None:
+            return bool(self.timestamp) and self.timestamp[-1] > timestamp
+        return any(
+            timestamps and timestamps[-1] > timestamp
+            for (source, _), timestamps in self._index.items()
+            if source == lap_source_id
+        )
+
+
+def _is_sorted(column: array, strict: bool = False) -> bool:
+    if strict:
+        return all(a < b for a, b in zip(column, column[1:]))
+    return all(a <= b for a, b in zip(column, column[1:]))
@@ -0,0 +1,235 @@
+import time
+from asyncio import Event
+from collections import Counter, OrderedDict
+
+from src.encoding import DELTA_KEYS, FORMATS, Frame, Update, encode, encode_delta, encode_ping
+from src.models import FeedOptions
+from src.settings import ClientQueue
+
+PING_FRAMES: dict[str, Frame] = {fmt: encode_ping(fmt) for fmt in FORMATS}
+
+
+class MailboxClosed(Exception):
+    """
+    Raised when reading from a mailbox that was closed because its client fell too far behind.
+    """
+
+
+class _Entry:
+    """
+    A pending update in a mailbox.
+    """
+
+    __slots__ = ("update", "variant", "merged", "removed", "version", "enqueued_at")
+
+    def __init__(self, update: Update, variant: str, enqueued_at: float):
+        self.update: Update = update
+        self.variant: str = variant
+        self.merged: dict[int, dict] | None = None  # Per team entries, only set once updates are merged
+        self.removed: set[int] = set()
+        self.version: int | None = update.version
+        self.enqueued_at: float = enqueued_at
+
+    def conflate(self, update: Update, variant: str):
+        """
+        Replaces the pending update with a newer one of the same topic.
+        Position updates and deltas are merged per team, so no team update gets lost.
+
+        Args:
+            update (Update): The newer update.
+            variant (str): The wire variant of the newer update.
+        """
+        if variant == "snapshot" or (variant == "full" and update.topic != "position"):
+            self.update = update
+            self.variant = variant
+            self.merged = None
+            self.removed = set()
+            self.version = update.version
+            return
+
+        key = DELTA_KEYS[update.topic]
+        if self.merged is None:
+            entries = self.update.delta if self.variant == "delta" else self.update.data
+            self.merged = {key(entry): entry for entry in entries}
+            self.removed = set(self.update.removed) if self.variant == "delta" else set()
+
+        for entry in update.delta if variant == "delta" else update.data:
+            self.merged[key(entry)] = entry
+            self.removed.discard(key(entry))
+        for removed in update.removed if variant == "delta" else ():
+            self.merged.pop(removed, None)
+            if self.variant == "delta":
+                self.removed.add(removed)
+        self.version = update.version
+
+    def encoded(self, fmt: str) -> Frame:
+        """
+        Returns the encoded update, only encoding updates that were merged for this client.
+
+        Args:
+            fmt (str): The wire format.
+
+        Returns:
+            Frame: The encoded update.
+        """
+        if self.merged is None:
+            return self.update.frame(self.variant, fmt)
+
+        topic = self.update.topic
+        entries = list(self.merged.values())
+        if self.variant == "delta":
+            return encode_delta(topic, self.version, self.update.base, entries, sorted(self.removed), fmt)
+        if self.variant == "snapshot":
+            return encode(topic, entries, self.version, fmt)
+        return encode(topic, entries, fmt=fmt)
+
+
+class Mailbox:
+    """
+    A bounded per-client queue of encoded frames.
+
+    Putting an update never blocks. Topics where only the newest value matters are conflated, so at most
+    one update per topic is pending. When the mailbox is still full the configured overflow policy decides
+    what happens, so a single slow consumer can never stall or grow a broadcast.
+    """
+
+    def __init__(self, config: ClientQueue, stats: Counter, options: FeedOptions) -> None:
+        """
+        Initializes a new mailbox.
+
+        Args:
+            config (ClientQueue): The queue size, conflated topics and overflow policy.
+            stats (Counter): The policy counters shared by all mailboxes of a publisher.
+            options (FeedOptions): The protocol mode and wire format of the client.
+        """
+        self._config: ClientQueue = config
+        self._stats: Counter = stats
+        self._pending: OrderedDict[str | int, _Entry] = OrderedDict()
+        self._sequence: int = 0
+        self._ready: Event = Event()
+        self.delta: bool = options.mode == "delta"
+        self.format: str = options.format
+        self.topics: frozenset[str] | None = None  # The subscribed topics, None for all topics
+        self.position_hz: int | None = None  # The position rate class, None to receive every position update
+        self.closed: bool = False
+        self.removed: bool = False  # Set when the client is removed from its publisher
+        self.last_sent: float = time.monotonic()  # Time a frame was last taken out to be sent
+        self._ping: bool = False
+
+    def __len__(self) -> int:
+        return len(self._pending)
+
+    def _variant(self, update: Update) -> str | None:
+        """
+        Selects the wire variant of an update for this client.
+
+        Args:
+            update (Update): The update.
+
+        Returns:
+            str | None: The variant, or None if the update carries nothing new for this client.
+        """
+        if not self.delta or update.topic not in DELTA_KEYS:
+            return "full"
+        if update.snapshot:
+            return "snapshot"
+        return "delta" if update.delta is not None else None
+
+    def put(self, update: Update):
+        """
+        Adds an update to the mailbox, conflating it with a pending update of the same topic
+        or applying the overflow policy when the mailbox is full.
+
+        Args:
+            update (Update): The update.
+        """
+        variant = self._variant(update)
+        if self.closed or variant is None:
+            return
+
+        topic = update.topic
+        if topic in self._config.conflate:
+            if topic in self._pending:
+                self._pending[topic].conflate(update, variant)
+                self._stats["conflated"] += 1
+                return
+            key = topic
+        else:
+            key = self._sequence
+            self._sequence += 1
+
+        now = time.monotonic()
+        if self._config.policy == "disconnect" and (
+            len(self._pending) >= self._config.size
+            or (self._pending and now - next(iter(self._pending.values())).enqueued_at > self._config.max_lag)
+        ):
+            self.close()
+            return
+
+        if len(self._pending) >= self._config.size:
+            if self._config.policy == "coalesce" and self._coalesce(topic):
+                self._stats["coalesced"] += 1
+            else:
+                self._pending.popitem(last=False)
+                self._stats["dropped"] += 1
+
+        self._pending[key] = _Entry(update, variant, now)
+        self._ready.set()
+
+    def _coalesce(self, topic: str) -> bool:
+        """
+        Removes the oldest pending frame of the given topic.
+
+        Args:
+            topic (str): The topic of the frame that is about to be added.
+
+        Returns:
+            bool: Whether a pending frame was removed.
+        """
+        for key, entry in self._pending.items():
+            if entry.update.topic == topic:
+                del self._pending[key]
+                return True
+        return False
+
+    def ping(self):
+        """
+        Requests a keep-alive ping, sent when no other frames are pending.
+        """
+        self._ping = True
+        self._ready.set()
+
+    async def get(self) -> Frame:
+        """
+        Waits for and returns the next frame.
+
+        Returns:
+            Frame: The oldest pending frame, or a ping if one was requested.
+
+        Raises:
+            MailboxClosed: If the mailbox was closed.
+        """
+        while not self._pending and not self._ping:
+            if self.closed:
+                raise MailboxClosed()
+            self._ready.clear()
+            await self._ready.wait()
+        if self.closed:
+            raise MailboxClosed()
+
+        self.last_sent = time.monotonic()
+        if not self._pending:
+            self._ping = False
+            return PING_FRAMES[self.format]
+        return self._pending.popitem(last=False)[1].encoded(self.format)
+
+    def close(self):
+        """
+        Closes the mailbox, dropping all pending frames and waking up the reader.
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self._pending.clear()
+        self._stats["disconnected"] += 1
+        self._ready.set()
@@ -1,6 +1,8 @@
-from typing import Optional
+from typing import Literal, Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, field_validator
+
+from src.encoding import FORMATS
 
 
 # Define the models for the received from Telraam
@@ -43,3 +45,33 @@ class FreezeTime(BaseModel):
 
 class ConnectionCount(BaseModel):
     count: int
+
+
+class FeedOptions(BaseModel):
+    mode: Literal["full", "delta"] = "full"
+    format: str = "json"  # Wire format, one of src.encoding.FORMATS
+    topics: list[str] | None = None  # Topics to subscribe to, all topics when not set
+    position_hz: int | None = None  # Rate of position updates, rounded down to one of the settings.positions rates
+    history: bool = False  # Send the recent positions of every team on connect
+
+    @field_validator("format")
+    @classmethod
+    def check_format(cls, fmt: str) -> str:
+        if fmt not in FORMATS:
+            raise ValueError(f"Unsupported format, expected one of {', '.join(FORMATS)}")
+        return fmt
+
+    @field_validator("position_hz")
+    @classmethod
+    def check_position_hz(cls, position_hz: int | None) -> int | None:
+        if position_hz is not None and position_hz <= 0:
+            raise ValueError("The position rate must be positive")
+        return position_hz
+
+    @field_validator("topics")
+    @classmethod
+    def split_topics(cls, topics: list[str] | None) -> list[str] | None:
+        # Allow both ?topics=a&topics=b and ?topics=a,b
+        if topics is None:
+            return None
+        return [topic for value in topics for topic in value.split(",") if topic]
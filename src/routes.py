@@ -1,18 +1,20 @@
 from typing import Annotated
 
 import httpx
-from fastapi import APIRouter, Depends, HTTPException, Request, WebSocket
-from fastapi.responses import HTMLResponse
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, WebSocket
+from fastapi.responses import HTMLResponse, Response, StreamingResponse
 from fastapi.templating import Jinja2Templates
 from starlette.status import (
     HTTP_202_ACCEPTED,
     HTTP_409_CONFLICT,
     HTTP_502_BAD_GATEWAY,
     HTTP_200_OK,
+    HTTP_304_NOT_MODIFIED,
 )
 
 from src.auth import is_admin
-from src.data_publisher import DataPublisher
+from src.cluster import ClusterClient
+from src.data_publisher import DataPublisher, refresh
 from src.dependecies import (
     get_settings,
     get_admin_publisher,
@@ -21,9 +23,23 @@ from src.dependecies import (
     get_feed_handler,
     get_admin_feed_handler,
     get_connection_tracker,
+    get_telraam_client,
+    get_fetcher,
+    get_event_stream_handler,
+    get_cluster_client,
+)
+from src.models import (
+    Count,
+    FreezeTime,
+    LapSource,
+    Message,
+    ConnectionCount,
+    PositionSource,
+    FeedOptions,
 )
-from src.models import FreezeTime, LapSource, Message, ConnectionCount, PositionSource
 from src.settings import Settings
+from src.sse import EventStreamHandler
+from src.tasks.fetcher import Fetcher
 from src.telraam import TelraamClient
 from src.websocket import WebSocketHandler, ConnectionTracker
 
@@ -37,9 +53,13 @@ async def _ping(_request: Request):
 
 @router.post("/api/force-client-refresh", dependencies=[Depends(is_admin)])
 async def _force_client_refresh(
+    settings: Annotated[Settings, Depends(get_settings)],
     feed_publisher: Annotated[DataPublisher, Depends(get_feed_publisher)],
+    window: int | None = None,
 ):
-    await feed_publisher.publish("refresh", True)
+    await feed_publisher.publish(
+        "refresh", refresh(window if window is not None else settings.interval.refresh)
+    )
 
 
 @router.post("/api/lap/use/{lap_source_id}", dependencies=[Depends(is_admin)])
@@ -47,31 +67,37 @@ async def _post_lap_source(
     lap_source_id: int,
     settings: Annotated[Settings, Depends(get_settings)],
     admin_publisher: Annotated[DataPublisher, Depends(get_admin_publisher)],
-    feed_publisher: Annotated[DataPublisher, Depends(get_feed_publisher)],
+    client: Annotated[TelraamClient, Depends(get_telraam_client)],
+    fetcher: Annotated[Fetcher, Depends(get_fetcher)],
 ):
     try:
-        lap_sources: list[dict]
-        async with TelraamClient(settings, admin_publisher) as client:
-            lap_sources = await client.get_lap_sources()
+        # The counts of every known lap source are ready, only ask Telraam about unknown ones
+        lap_source: LapSource | None = fetcher.lap_source(lap_source_id)
+        if lap_source is None:
+            lap_sources: list[dict] = await client.get_lap_sources(refresh=True)
+            # The fetcher only publishes sources that changed since its client last saw them
+            await admin_publisher.publish("lap-source", lap_sources)
+            await admin_publisher.publish("telraam-health", "good")
 
-        lap_sources_by_id: dict[int, LapSource] = {
-            ls.id: ls for ls in [LapSource(**ls) for ls in lap_sources]
-        }
-        await admin_publisher.publish("telraam-health", "good")
-        if lap_source_id in lap_sources_by_id:
+            lap_sources_by_id: dict[int, LapSource] = {
+                ls.id: ls for ls in [LapSource(**ls) for ls in lap_sources]
+            }
+            if lap_source_id not in lap_sources_by_id:
+                raise HTTPException(
+                    status_code=HTTP_409_CONFLICT, detail="Invalid LapSource Id"
+                )
             lap_source = lap_sources_by_id[lap_source_id]
-            await admin_publisher.publish("active-lap-source", lap_source.model_dump())
-            settings.lap_source.id = lap_source.id
-            settings.lap_source.name = lap_source.name
-            settings.persist()
-        else:
-            raise HTTPException(
-                status_code=HTTP_409_CONFLICT, detail="Invalid LapSource Id"
-            )
 
-        await feed_publisher.publish("refresh", True)
+        await admin_publisher.publish("active-lap-source", lap_source.model_dump())
+        settings.lap_source.id = lap_source.id
+        settings.lap_source.name = lap_source.name
+        settings.persist()
+
+        # Push the counts of the new source, clients update without reloading
+        if not await fetcher.publish_counts():
+            fetcher.trigger()
         return ["ok"]
-    except httpx.ConnectError:
+    except (httpx.ConnectError, httpx.TimeoutException, httpx.HTTPStatusError):
         await admin_publisher.publish("telraam-health", "bad")
         raise HTTPException(
             status_code=HTTP_502_BAD_GATEWAY, detail="Can't reach data server"
@@ -84,11 +110,12 @@ async def _post_position_source(
     settings: Annotated[Settings, Depends(get_settings)],
     admin_publisher: Annotated[DataPublisher, Depends(get_admin_publisher)],
     feed_publisher: Annotated[DataPublisher, Depends(get_feed_publisher)],
+    client: Annotated[TelraamClient, Depends(get_telraam_client)],
 ):
     try:
-        position_sources: list[dict]
-        async with TelraamClient(settings, admin_publisher) as client:
-            position_sources = await client.get_position_sources()
+        position_sources: list[dict] = await client.get_position_sources(refresh=True)
+        # The fetcher only publishes sources that changed since its client last saw them
+        await admin_publisher.publish("position-source", position_sources)
 
         position_sources_by_id: dict[int, PositionSource] = {
             ps.id: ps for ps in [PositionSource(**ps) for ps in position_sources]
@@ -106,9 +133,9 @@ async def _post_position_source(
             raise HTTPException(
                 status_code=HTTP_409_CONFLICT, detail="Invalid PositionSource Id"
             )
-        await feed_publisher.publish("refresh", True)
+        await feed_publisher.publish("refresh", refresh(settings.interval.refresh))
         return ["ok"]
-    except httpx.ConnectError:
+    except (httpx.ConnectError, httpx.TimeoutException, httpx.HTTPStatusError):
         await admin_publisher.publish("telraam-health", "bad")
         raise HTTPException(
             status_code=HTTP_502_BAD_GATEWAY, detail="Can't reach data server"
@@ -147,10 +174,13 @@ async def _post_freeze(
     time: FreezeTime,
     settings: Annotated[Settings, Depends(get_settings)],
     admin_publisher: Annotated[DataPublisher, Depends(get_admin_publisher)],
+    fetcher: Annotated[Fetcher, Depends(get_fetcher)],
 ):
     settings.site.freeze = time.time
     settings.persist()
     await admin_publisher.publish("freeze", time.time)
+    # Counts are only recomputed by a fetch
+    fetcher.trigger()
 
 
 @router.delete(
@@ -160,11 +190,37 @@ async def _delete_freeze(
     settings: Annotated[Settings, Depends(get_settings)],
     feed_publisher: Annotated[DataPublisher, Depends(get_feed_publisher)],
     admin_publisher: Annotated[DataPublisher, Depends(get_admin_publisher)],
+    fetcher: Annotated[Fetcher, Depends(get_fetcher)],
 ):
     settings.site.freeze = None
     settings.persist()
     await feed_publisher.publish("frozen", False)
     await admin_publisher.publish("freeze", None)
+    # Counts are only recomputed by a fetch
+    fetcher.trigger()
+
+
+@router.get(
+    "/api/counts",
+    status_code=HTTP_200_OK,
+    response_model=list[Count],
+    dependencies=[Depends(is_admin)],
+)
+async def _counts(
+    fetcher: Annotated[Fetcher, Depends(get_fetcher)],
+    cluster_client: Annotated[ClusterClient | None, Depends(get_cluster_client)],
+    at: int | None = None,
+    source: int | None = None,
+):
+    # The lap counts of a lap source (the active one by default) up to a timestamp in milliseconds
+    # A worker doesn't fetch laps, so it asks the ingest process
+    if cluster_client is not None:
+        status, data = await cluster_client.query("counts", at=at, source=source)
+    else:
+        status, data = fetcher.query_counts(at, source)
+    if status != HTTP_200_OK:
+        raise HTTPException(status_code=status, detail=data)
+    return data
 
 
 @router.get("/api/count", status_code=HTTP_200_OK, response_model=ConnectionCount)
@@ -182,6 +238,38 @@ async def _count(
         raise HTTPException(status_code=403)
 
 
+@router.get("/api/snapshot", status_code=HTTP_200_OK)
+async def _snapshot(
+    request: Request,
+    settings: Annotated[Settings, Depends(get_settings)],
+    feed_publisher: Annotated[DataPublisher, Depends(get_feed_publisher)],
+    options: Annotated[FeedOptions, Query()],
+):
+    # The cached feed data as the list of messages a new /feed client receives, cacheable by HTTP caches
+    body, etag = feed_publisher.body(frozenset(options.topics) if options.topics is not None else None)
+    headers = {
+        "ETag": etag,
+        "Cache-Control": f"public, max-age={settings.snapshot.max_age}, "
+        f"stale-while-revalidate={settings.snapshot.stale_while_revalidate}",
+    }
+    if etag in (tag.strip() for tag in request.headers.get("If-None-Match", "").split(",")):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(content=body, media_type="application/json", headers=headers)
+
+
+@router.get("/api/stream")
+async def _stream(
+    options: Annotated[FeedOptions, Query()],
+    event_stream_handler: Annotated[EventStreamHandler, Depends(get_event_stream_handler)],
+):
+    return StreamingResponse(
+        event_stream_handler.stream(options),
+        media_type="text/event-stream",
+        # Don't let proxies buffer the events
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @router.get(
     "/admin",
     status_code=HTTP_200_OK,
@@ -198,14 +286,16 @@ async def _admin(
 @router.websocket("/feed")
 async def _feed(
     websocket: WebSocket,
+    options: Annotated[FeedOptions, Query()],
     feed_handler: Annotated[WebSocketHandler, Depends(get_feed_handler)],
 ):
-    await feed_handler.connect(websocket)
+    await feed_handler.connect(websocket, options)
 
 
 @router.websocket("/admin/feed", dependencies=[Depends(is_admin)])
 async def _feed_admin(
     websocket: WebSocket,
+    options: Annotated[FeedOptions, Query()],
     admin_feed_handler: Annotated[WebSocketHandler, Depends(get_admin_feed_handler)],
 ):
-    await admin_feed_handler.connect(websocket)
+    await admin_feed_handler.connect(websocket, options)
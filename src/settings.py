@@ -1,5 +1,9 @@
+import os
+import tempfile
+from typing import Callable, Literal
+
 import yaml
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr, field_validator
 
 
 class Admin(BaseModel):
@@ -19,6 +23,22 @@ class Interval(BaseModel):
     feed: int  # Interval to fetch data from the Telraam API
     fetch: int  # Interval to wait for new data in a DataPublisher queue
     websocket: int  # Interval to wait when retrying to establish a websocket connection
+    refresh: int = 0  # Window over which clients reload after a refresh, 0 to reload at once
+    reconcile: int = 60  # Interval to fetch all laps instead of only the new ones, to pick up deleted or changed laps
+    catalog: int = 30  # Interval to check the teams, lap sources and position sources for changes
+    persist: float = 1  # Seconds to coalesce setting changes before writing them to the YAML file
+    config: float = 2  # Interval to check the YAML file for external edits
+
+
+class Polling(BaseModel):
+    """
+    Fetch scheduling, in between the fetches triggered by Telraam websocket events
+    """
+
+    triggers: list[str] = ["lap"]  # Telraam websocket topics that trigger a fetch right away
+    debounce: float = 0.25  # Seconds to wait for more events before a triggered fetch
+    idle: int = 30  # Maximum seconds between fetches, the interval stretches up to this while nothing changes
+    backoff: int = 60  # Maximum seconds between fetches, the interval backs off up to this while Telraam is unhealthy
 
 
 class Site(BaseModel):
@@ -48,6 +68,112 @@ class PositionSource(BaseModel):
     name: str | None
 
 
+class ClientQueue(BaseModel):
+    """
+    Per-client queue settings
+    """
+
+    size: int = 256  # Maximum amount of pending messages per client
+    conflate: list[str] = ["counts", "position", "active-connections"]  # Topics where only the newest value matters
+    policy: Literal["drop-oldest", "coalesce", "disconnect"] = "drop-oldest"  # What to do when a queue is full
+    max_lag: int = 30  # Seconds a client may lag behind before it is disconnected by the disconnect policy
+
+
+class Positions(BaseModel):
+    """
+    Position update rates
+    """
+
+    rates: list[int] = [1, 2, 5, 10]  # Update rates in Hz clients can choose from with ?position_hz=
+    default: int | None = 10  # Update rate of clients that don't choose one, None to forward every upstream message
+    history: int = 64  # Recent positions kept per team and position source, sent to clients that ask for them
+
+    @field_validator("rates")
+    @classmethod
+    def check_rates(cls, rates: list[int]) -> list[int]:
+        if any(rate <= 0 for rate in rates):
+            raise ValueError("The position rates must be positive")
+        return rates
+
+    @field_validator("default")
+    @classmethod
+    def check_default(cls, default: int | None) -> int | None:
+        if default is not None and default <= 0:
+            raise ValueError("The default position rate must be positive")
+        return default
+
+
+class Snapshot(BaseModel):
+    """
+    HTTP caching of /api/snapshot
+    """
+
+    max_age: int = 1  # Seconds an HTTP cache may serve a snapshot without asking Loxsi
+    stale_while_revalidate: int = 5  # Seconds an HTTP cache may serve an old snapshot while it fetches a new one
+
+
+class Admission(BaseModel):
+    """
+    Websocket admission control
+    """
+
+    handshakes: int = 64  # Maximum amount of websocket handshakes in progress at once
+    timeout: int = 10  # Seconds a handshake may wait before the client is asked to retry later
+
+
+class Cluster(BaseModel):
+    """
+    Multi-process settings, used when running with LOXSI_ROLE set to ingest or worker
+    """
+
+    socket: str = "tmp/loxsi.sock"  # Unix socket the ingest process listens on
+    limit: int = 16 * 1024 * 1024  # Maximum size in bytes of a message or of the buffered updates of a worker
+    timeout: float = 5  # Seconds a worker waits for the ingest process to answer a query
+
+
+class TelraamHttp(BaseModel):
+    """
+    Connection pool of the shared Telraam client
+    """
+
+    connections: int = 20  # Maximum amount of open connections
+    keep_alive: int = 10  # Maximum amount of idle connections kept open
+    keep_alive_expiry: float = 30  # Seconds an idle connection is kept open
+    http2: bool = True  # Use HTTP/2 when Telraam supports it, needs the http2 extra
+    timeout: float = 5  # Seconds a request may take
+    timeouts: dict[str, float] = {"lap": 30, "accepted-laps": 30}  # Seconds a request may take, per endpoint
+
+
+class Supervisor(BaseModel):
+    """
+    Restarting of crashed background tasks
+    """
+
+    backoff: float = 1  # Seconds to wait before restarting a crashed task, doubled after every crash
+    max_backoff: float = 60  # Maximum seconds to wait before restarting a task or reconnecting to Telraam
+    jitter: float = 0.5  # Fraction of the wait that is randomised, so tasks don't restart in lockstep
+    healthy: float = 60  # Seconds a task has to run before its backoff is reset
+
+
+class Storage(BaseModel):
+    """
+    Persistence of the published counts
+    """
+
+    path: str = "tmp/loxsi.db"  # SQLite database the counts are written to
+    flush: float = 1  # Seconds to batch writes for
+    compact: int = 600  # Interval to checkpoint the write-ahead log into the database
+
+
+class TelraamReplica(BaseModel):
+    """
+    Telraam urls / uris of a redundant upstream
+    """
+
+    api: str | None = None
+    ws: str | None = None
+
+
 class Telraam(BaseModel):
     """
     Telraam urls / uris
@@ -55,6 +181,16 @@ class Telraam(BaseModel):
 
     api: str
     ws: str
+    lap_cursor: str | None = "after"  # Query parameter to only fetch the laps with a higher id, None to always fetch all laps
+    http: TelraamHttp = TelraamHttp()
+    replicas: list[TelraamReplica] = []  # Redundant upstreams that are used at the same time, the first answer wins
+    dedup: float = 1  # Seconds a message of one upstream is recognized as a duplicate of another upstream
+
+    def apis(self) -> list[str]:
+        return [self.api] + [replica.api for replica in self.replicas if replica.api]
+
+    def websockets(self) -> list[str]:
+        return [self.ws] + [replica.ws for replica in self.replicas if replica.ws]
 
 
 class Settings(BaseModel):
@@ -70,17 +206,102 @@ class Settings(BaseModel):
     source_file: str
     telraam: Telraam
     api_token: str
+    queue: ClientQueue = ClientQueue()
+    positions: Positions = Positions()
+    snapshot: Snapshot = Snapshot()
+    admission: Admission = Admission()
+    cluster: Cluster = Cluster()
+    polling: Polling = Polling()
+    storage: Storage = Storage()
+    supervisor: Supervisor = Supervisor()
+
+    _persist_hook: Callable[["Settings"], None] | None = PrivateAttr(default=None)
+    _write_hook: Callable[[], None] | None = PrivateAttr(default=None)
+
+    def on_persist(self, hook: Callable[["Settings"], None]):
+        """
+        Replaces writing the settings to the YAML file on persist by the given hook.
+
+        Args:
+            hook (Callable): Called with the settings instead of writing them, it can still call `write`.
+        """
+        self._persist_hook = hook
+
+    def on_write(self, hook: Callable[[], None]):
+        """
+        Replaces writing the settings to the YAML file on write by the given hook, e.g. to write in the background.
+
+        Args:
+            hook (Callable): Called instead of writing the settings, it can still call `write_file`.
+        """
+        self._write_hook = hook
+
+    def update(self, data: dict):
+        """
+        Updates the settings in place, so every component holding (a part of) the settings sees the changes.
+
+        Args:
+            data (dict): The new settings, without the source file.
+        """
+        new = Settings(source_file=self.source_file, **data)
+
+        def _assign(target: BaseModel, source: BaseModel):
+            for name in type(target).model_fields:
+                value = getattr(source, name)
+                if isinstance(value, BaseModel) and isinstance(getattr(target, name), BaseModel):
+                    _assign(getattr(target, name), value)
+                else:
+                    setattr(target, name, value)
+
+        _assign(self, new)
 
     def persist(self):
         """
         Persists the settings to a YAML file.
         """
-        with open(self.source_file, "w") as file:
-            file.write(
-                yaml.dump(
-                    self.model_dump(exclude={"source_file"}), default_flow_style=False
-                )
-            )
+        if self._persist_hook is not None:
+            self._persist_hook(self)
+        else:
+            self.write()
+
+    def write(self):
+        """
+        Writes the settings to the YAML file, or hands them to the write hook.
+        """
+        if self._write_hook is not None:
+            self._write_hook()
+        else:
+            self.write_file(self.dump())
+
+    def dump(self) -> str:
+        """
+        Dumps the settings as YAML.
+
+        Returns:
+            str: The YAML document.
+        """
+        return yaml.dump(self.model_dump(exclude={"source_file"}), default_flow_style=False)
+
+    def write_file(self, document: str):
+        """
+        Atomically replaces the YAML file by the given document, a crash never leaves a truncated file.
+
+        Args:
+            document (str): The YAML document.
+        """
+        directory = os.path.dirname(os.path.abspath(self.source_file))
+        fd, path = tempfile.mkstemp(dir=directory, prefix=".", suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as file:
+                file.write(document)
+                file.flush()
+                os.fsync(file.fileno())
+            if os.path.exists(self.source_file):
+                os.chmod(path, os.stat(self.source_file).st_mode & 0o7777)
+            os.replace(path, self.source_file)
+        except BaseException:
+            os.unlink(path)
+            raise
 
     @classmethod
     def load_from_yaml(cls, file_path: str) -> "Settings":
@@ -0,0 +1,62 @@
+from typing import AsyncIterator
+
+from src.data_publisher import DataPublisher
+from src.mailbox import Mailbox, MailboxClosed
+from src.models import FeedOptions
+from src.tasks.heartbeat import Heartbeat
+from src.websocket import ConnectionTracker
+
+
+class EventStreamHandler:
+    """
+    Streams the feed as Server-Sent Events, for read-only clients that can't or don't want to use a websocket.
+    """
+
+    def __init__(
+            self,
+            publisher: DataPublisher,
+            connection_tracker: ConnectionTracker,
+            heartbeat: Heartbeat
+    ):
+        """
+        Initializes a new instance of the EventStreamHandler class.
+
+        Args:
+            publisher (DataPublisher): The data publisher object used for publishing data.
+            connection_tracker (ConnectionTracker): Track the connection count.
+            heartbeat (Heartbeat): Pings the idle clients.
+        """
+        self._publisher: DataPublisher = publisher
+        self._connection_tracker: ConnectionTracker = connection_tracker
+        self._heartbeat: Heartbeat = heartbeat
+
+    async def stream(self, options: FeedOptions = FeedOptions()) -> AsyncIterator[str]:
+        """
+        Adds a client to the data publisher and streams its events until it disconnects.
+
+        Args:
+            options (FeedOptions): The feed options requested by the client.
+
+        Returns:
+            AsyncIterator[str]: The events, one `data:` line with the same JSON message as the websocket feed.
+
+        Notes:
+            The client is only added once the response starts streaming, in the same frame that removes it,
+            so a client that leaves before that never holds a queue.
+            Events can't be answered, so the stream always uses the full protocol mode and the JSON format.
+        """
+        options = options.model_copy(update={"mode": "full", "format": "json"})
+        queue: Mailbox = await self._publisher.add(options)
+        counted = False
+        try:
+            self._heartbeat.schedule(queue)
+            await self._connection_tracker.inc()
+            counted = True
+            while True:
+                yield f"data: {await queue.get()}\n\n"
+        except MailboxClosed:
+            return
+        finally:
+            if counted:
+                await self._connection_tracker.dec()
+            await self._publisher.remove(queue)
@@ -1,31 +1,127 @@
-from datetime import datetime, timedelta
-from os.path import isfile
+import asyncio
 import json
 import logging
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os.path import isfile
 
 from src.data_publisher import DataPublisher
+from src.encoding import JsonData
+from src.settings import Settings
+
+# Snapshot written by older versions, only read when the database has no counts yet
+LEGACY_COUNTS_FILE = "tmp/counts.json"
+
 
 class Storeman:
+    """
+    Persists the last published counts to a SQLite database in WAL mode, so a restart recovers them.
 
-    def __init__(self, feed_publisher: DataPublisher ) -> None:
-        self.lastSave: datetime | None = None
+    Storing only records the newest value in memory. A single worker thread writes the pending values
+    in batches every `storage.flush` seconds, so persistence never blocks the event loop.
+    The write-ahead log is checkpointed every `storage.compact` seconds to keep it small.
+    """
+
+    def __init__(self, settings: Settings, feed_publisher: DataPublisher) -> None:
+        self._settings: Settings = settings
         self._feed_publisher: DataPublisher = feed_publisher
         self.logger = logging.getLogger("uvicorn")
+        # Topic -> newest data that has not been written yet
+        self._pending: dict[str, JsonData] = {}
+        # Topic -> data as last written to or read from the database
+        self._stored: dict[str, JsonData] = {}
+        self._dirty: asyncio.Event = asyncio.Event()
+        # The SQLite connection is only used from this thread
+        self._executor: ThreadPoolExecutor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storeman")
+        self._connection: sqlite3.Connection | None = None
+        self._compacted: float = time.monotonic()
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._connection is None:
+            self._connection = sqlite3.connect(self._settings.storage.path)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS state (topic TEXT PRIMARY KEY, data TEXT NOT NULL, updated REAL NOT NULL)"
+            )
+        return self._connection
+
+    def _write(self, batch: dict[str, JsonData]):
+        connection = self._connect()
+        now = time.time()
+        with connection:
+            connection.executemany(
+                "INSERT INTO state (topic, data, updated) VALUES (?, ?, ?) "
+                "ON CONFLICT (topic) DO UPDATE SET data = excluded.data, updated = excluded.updated",
+                [(topic, json.dumps(data), now) for topic, data in batch.items()],
+            )
+        if time.monotonic() - self._compacted >= self._settings.storage.compact:
+            connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._compacted = time.monotonic()
 
-    async def storeScores(self, counts: list[dict]):
-        if self.lastSave and self.lastSave > (datetime.now() - timedelta(minutes=10)):
+    def _read(self) -> dict[str, JsonData]:
+        rows = self._connect().execute("SELECT topic, data FROM state").fetchall()
+        return {topic: json.loads(data) for topic, data in rows}
+
+    def _close(self):
+        if self._connection is not None:
+            self._connection.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self._connection.close()
+            self._connection = None
+
+    def storeScores(self, counts: list[dict]):
+        """
+        Schedules the counts to be written, replacing counts that were not written yet.
+        Counts equal to the stored ones are not written again.
+
+        Args:
+            counts (list): The published counts.
+        """
+        if counts == self._stored.get("counts"):
+            self._pending.pop("counts", None)
             return
-        self.lastSave = datetime.now()
-        self.logger.info("Storing counts to cache")
-        with open("tmp/counts.json", "+w") as f:
-            f.write(json.dumps(counts))
+        self._pending["counts"] = counts
+        self._dirty.set()
+
+    async def _flush(self):
+        batch, self._pending = self._pending, {}
+        if batch:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._write, batch)
+            self._stored.update(batch)
+
+    async def run(self):
+        """
+        Writes the pending values in batches until cancelled.
+        """
+        while True:
+            await self._dirty.wait()
+            # Wait for more values to batch them into one transaction
+            await asyncio.sleep(self._settings.storage.flush)
+            self._dirty.clear()
+            try:
+                await self._flush()
+            except sqlite3.Error:
+                self.logger.exception("Storing counts failed")
+
+    async def close(self):
+        """
+        Writes the pending values and closes the database.
+        """
+        await self._flush()
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._close)
+        self._executor.shutdown()
 
     async def loadScores(self):
-        if not isfile("tmp/counts.json"):
+        loop = asyncio.get_running_loop()
+        state = await loop.run_in_executor(self._executor, self._read)
+        self._stored.update(state)
+        if "counts" not in state and isfile(LEGACY_COUNTS_FILE):
+            with open(LEGACY_COUNTS_FILE) as f:
+                state["counts"] = json.load(f)
+
+        if "counts" not in state:
             self.logger.warning("No counts loaded from cache")
             return
-        
-        with open("tmp/counts.json", "+r") as f:
-            counts = json.load(f)
-            await self._feed_publisher.publish("counts", counts)
 
+        await self._feed_publisher.publish("counts", state["counts"])
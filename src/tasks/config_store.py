@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import os
+from typing import Callable
+
+import yaml
+from pydantic import ValidationError
+
+from src.data_publisher import DataPublisher, refresh
+from src.settings import Settings
+from src.tasks.fetcher import Fetcher
+from src.tasks.task import Task
+
+_MISSING = object()
+
+
+def _merge(base, ours, theirs):
+    """
+    Merges two edits of the same settings, a value changed by us wins over the value in their edit.
+
+    Args:
+        base: The settings both edits started from.
+        ours: The live settings.
+        theirs: The settings in the file.
+
+    Returns:
+        The merged settings, _MISSING when the key should be left out.
+    """
+    if isinstance(base, dict) and isinstance(ours, dict) and isinstance(theirs, dict):
+        merged = {}
+        for key in ours.keys() | theirs.keys():
+            value = _merge(base.get(key, _MISSING), ours.get(key, _MISSING), theirs.get(key, _MISSING))
+            if value is not _MISSING:
+                merged[key] = value
+        return merged
+    return ours if ours != base else theirs
+
+
+class ConfigStore(Task):
+    """
+    ConfigStore class writes the settings to the YAML file in the background and applies external edits of the file.
+
+    Changes are coalesced for `interval.persist` seconds and written atomically from a worker thread,
+    so admin actions never block the event loop. The file is checked for external edits every
+    `interval.config` seconds, which are applied to the live settings and published without a restart.
+    The file is also checked right before every write, so an external edit is never overwritten:
+    it is merged with the pending changes, which win for the settings they changed.
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        feed_publisher: DataPublisher,
+        admin_publisher: DataPublisher,
+        fetcher: Fetcher,
+        on_reload: Callable[[], None] | None = None,
+    ):
+        super().__init__(settings, feed_publisher, admin_publisher)
+        self._fetcher: Fetcher = fetcher
+        # Called after an external edit was applied, e.g. to forward the settings to the workers
+        self._on_reload: Callable[[], None] | None = on_reload
+        self._dirty: asyncio.Event = asyncio.Event()
+        # Modification time of the file as last written or read by Loxsi
+        self._mtime: int | None = self._stat()
+        # The settings as last written or read by Loxsi, to tell our changes from the external edits
+        self._synced: dict = self._snapshot()
+        self.logger = logging.getLogger("uvicorn")
+
+    def start(self):
+        """
+        Makes the settings write through this store.
+        """
+        self._settings.on_write(self._dirty.set)
+
+    def _stat(self) -> int | None:
+        try:
+            return os.stat(self._settings.source_file).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _snapshot(self) -> dict:
+        # Round trip through YAML so the snapshot compares equal to the file contents
+        return yaml.safe_load(self._settings.dump())
+
+    async def _write(self):
+        # Apply an external edit first instead of overwriting it
+        await self._reload()
+        self._dirty.clear()
+        # Dump on the event loop so the document is a consistent snapshot of the settings
+        document = self._settings.dump()
+        await asyncio.to_thread(self._settings.write_file, document)
+        self._mtime = self._stat()
+        self._synced = yaml.safe_load(document)
+
+    def _read(self) -> dict:
+        with open(self._settings.source_file, "r") as f:
+            return yaml.safe_load(f)
+
+    async def _reload(self):
+        mtime = self._stat()
+        if mtime is None or mtime == self._mtime:
+            return
+        self._mtime = mtime
+
+        try:
+            data = await asyncio.to_thread(self._read)
+            before = self._settings.model_dump()
+            self._settings.update(_merge(self._synced, self._snapshot(), data))
+        except (OSError, yaml.YAMLError, ValidationError, TypeError) as e:
+            self.logger.warning(f"Ignoring invalid edit of {self._settings.source_file}: {e}")
+            return
+
+        self._synced = data
+        self.logger.info(f"Applied external edit of {self._settings.source_file}")
+        await self._publish_changes(before)
+        if self._on_reload is not None:
+            self._on_reload()
+
+    async def _publish_changes(self, before: dict):
+        """
+        Publishes the settings that changed the same way the admin routes do.
+
+        Args:
+            before (dict): The dumped settings before the edit.
+        """
+        settings = self._settings
+        if settings.site.message != before["site"]["message"]:
+            await self._feed_publisher.publish("message", settings.site.message)
+        if settings.site.freeze != before["site"]["freeze"]:
+            await self._admin_publisher.publish("freeze", settings.site.freeze)
+            if settings.site.freeze is None:
+                await self._feed_publisher.publish("frozen", False)
+            self._fetcher.trigger()
+        if settings.lap_source.model_dump() != before["lap_source"]:
+            await self._admin_publisher.publish("active-lap-source", settings.lap_source.model_dump())
+            if not await self._fetcher.publish_counts():
+                self._fetcher.trigger()
+        if settings.position_source.model_dump() != before["position_source"]:
+            await self._admin_publisher.publish("active-position-source", settings.position_source.model_dump())
+            await self._feed_publisher.publish("refresh", refresh(settings.interval.refresh))
+
+    async def run(self):
+        """
+        Writes pending changes and checks for external edits until cancelled.
+        """
+        while True:
+            try:
+                await asyncio.wait_for(self._dirty.wait(), self._settings.interval.config)
+            except asyncio.TimeoutError:
+                await self._reload()
+                continue
+
+            # Coalesce the changes made in quick succession
+            await asyncio.sleep(self._settings.interval.persist)
+            try:
+                await self._write()
+            except OSError:
+                self.logger.exception(f"Writing {self._settings.source_file} failed")
+
+    async def close(self):
+        """
+        Writes pending changes.
+        """
+        if self._dirty.is_set():
+            await self._write()
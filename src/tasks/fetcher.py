@@ -1,10 +1,14 @@
 import asyncio
+import time
 import traceback
 
-from httpx import ConnectError
+from httpx import HTTPError
+from starlette.status import HTTP_200_OK, HTTP_404_NOT_FOUND, HTTP_503_SERVICE_UNAVAILABLE
 
 from src.data_publisher import DataPublisher
-from src.models import Count, Lap, LapSource, Team
+from src.encoding import JsonData
+from src.laps import LapStore
+from src.models import Count, LapSource, Team
 from src.settings import Settings
 from src.tasks.task import Task
 from src.telraam import TelraamClient
@@ -21,94 +25,285 @@ class Fetcher(Task):
         settings: Settings,
         feed_publisher: DataPublisher,
         admin_publisher: DataPublisher,
-        storeman: Storeman
+        storeman: Storeman,
+        client: TelraamClient,
     ):
         self.storeman = storeman
+        self._client: TelraamClient = client
+        # Local copies of the laps per lap endpoint, only new laps are fetched in between reconciliations
+        self._stores: dict[str, LapStore] = {"lap": LapStore(), "accepted-laps": LapStore()}
+        self._reconciled: dict[str, float] = {}
+        self._teams: list[Team] = []
+        self._lap_sources: list[LapSource] = []
+        # Catalog endpoint -> the catalog the teams and lap sources were parsed from
+        self._catalogs: dict[str, list[dict]] = {}
+        # Lap source id -> counts, kept for every lap source so switching sources doesn't need a fetch
+        self._source_counts: dict[int, list[dict]] = {}
+        # Set by Telraam websocket events that warrant a fetch before the next scheduled one
+        self._triggered: asyncio.Event = asyncio.Event()
         super().__init__(settings, feed_publisher, admin_publisher)
 
+    def trigger(self):
+        """
+        Requests a fetch as soon as possible, bursts of triggers are debounced into a single fetch.
+        """
+        self._triggered.set()
+
+    def _next_delay(self, delay: float, changed: bool, failures: int) -> float:
+        """
+        Computes the delay until the next scheduled fetch.
+
+        Args:
+            delay (float): The previous delay.
+            changed (bool): Whether the last fetch changed the counts.
+            failures (int): The amount of consecutive failed fetches.
+
+        Returns:
+            float: The delay in seconds.
+        """
+        polling = self._settings.polling
+        interval = self._settings.interval.fetch
+        if failures:
+            # Back off exponentially while Telraam is unhealthy
+            return min(interval * 2 ** failures, max(polling.backoff, interval))
+        if changed:
+            return interval
+        # Stretch the interval while nothing changes
+        return min(delay * 1.5, max(polling.idle, interval))
+
+    async def _wait(self, delay: float, failures: int):
+        """
+        Waits until the next scheduled fetch or until a fetch is triggered.
+
+        Args:
+            delay (float): The delay until the next scheduled fetch.
+            failures (int): The amount of consecutive failed fetches, triggers are ignored while Telraam is unhealthy.
+        """
+        if failures:
+            await asyncio.sleep(delay)
+            return
+        try:
+            await asyncio.wait_for(self._triggered.wait(), delay)
+        except asyncio.TimeoutError:
+            return
+        # Wait for the rest of a burst of events
+        await asyncio.sleep(self._settings.polling.debounce)
+
+    async def _sync_laps(self, endpoint: str) -> LapStore:
+        """
+        Fetches the laps after the cursor of the local store, or all laps when a reconciliation is due.
+
+        Args:
+            endpoint (str): The lap endpoint, either lap or accepted-laps.
+
+        Returns:
+            LapStore: The updated store.
+        """
+        store = self._stores[endpoint]
+        get_laps = self._client.get_accepted_laps if endpoint == "accepted-laps" else self._client.get_laps
+
+        now = time.monotonic()
+        if store.cursor is None or now - self._reconciled.get(endpoint, 0) >= self._settings.interval.reconcile:
+            store.replace(await get_laps())
+            self._reconciled[endpoint] = now
+        else:
+            store.extend(await get_laps(after=store.cursor))
+        return store
+
+    def _store(self, lap_source: LapSource) -> tuple[LapStore, int | None]:
+        """
+        Returns the store holding the laps of a lap source.
+
+        Args:
+            lap_source (LapSource): The lap source.
+
+        Returns:
+            tuple: The store and the lap source id to filter its laps by, None to use all laps of the store.
+        """
+        if lap_source.name == "accepted-laps":
+            return self._stores["accepted-laps"], None
+        return self._stores["lap"], lap_source.id
+
+    def _count(self, lap_source: LapSource) -> list[dict]:
+        """
+        Counts the laps of every team for a lap source, up to the freeze time.
+
+        Args:
+            lap_source (LapSource): The lap source.
+
+        Returns:
+            list: The counts.
+        """
+        return self.counts_at(lap_source, self._settings.site.freeze)
+
+    def counts_at(self, lap_source: LapSource, at: int | None) -> list[dict]:
+        """
+        Counts the laps of every team for a lap source up to a point in time.
+        Answered from the timestamp index of the lap store, in logarithmic time per team.
+
+        Args:
+            lap_source (LapSource): The lap source.
+            at (int | None): The timestamp in milliseconds, None for all laps.
+
+        Returns:
+            list: The counts.
+        """
+        store, lap_source_id = self._store(lap_source)
+        lap_counts = store.counts(lap_source_id, at)
+        return [Count(count=lap_counts[team.id], team=team).model_dump() for team in self._teams]
+
+    async def publish_counts(self) -> bool:
+        """
+        Publishes the counts of the active lap source to the feed.
+        The counts of every lap source are computed on each fetch, so this is all it takes to switch lap sources.
+
+        Returns:
+            bool: Whether counts of the active lap source were available.
+        """
+        counts = self._source_counts.get(self._settings.lap_source.id)
+        if counts is None:
+            return False
+
+        # Filter laps by freeze time
+        if self._settings.site.freeze is not None:
+            # If the filter removes laps, we now the scoreboard is frozen
+            store, lap_source_id = self._store(self._settings.lap_source)
+            await self._feed_publisher.publish(
+                "frozen", store.has_laps_after(lap_source_id, self._settings.site.freeze)
+            )
+
+        self.storeman.storeScores(counts)
+
+        await self._feed_publisher.publish("counts", counts)
+        return True
+
+    def query_counts(self, at: int | None = None, source: int | None = None) -> tuple[int, JsonData]:
+        """
+        Answers a point-in-time counts query, as served by /api/counts.
+
+        Args:
+            at (int | None): The timestamp in milliseconds, None for all laps.
+            source (int | None): The id of the lap source, None for the active one.
+
+        Returns:
+            tuple: The HTTP status and the counts, or the error detail.
+        """
+        if not self.ready:
+            return HTTP_503_SERVICE_UNAVAILABLE, "No laps fetched yet"
+        lap_source = self._settings.lap_source if source is None else self.lap_source(source)
+        if lap_source is None:
+            return HTTP_404_NOT_FOUND, "Invalid LapSource Id"
+        return HTTP_200_OK, self.counts_at(lap_source, at)
+
+    @property
+    def ready(self) -> bool:
+        """
+        Returns whether the laps and teams have been fetched, which is never the case in a worker process.
+
+        Returns:
+            bool: Whether counts can be computed.
+        """
+        return bool(self._teams)
+
+    def lap_source(self, lap_source_id: int) -> LapSource | None:
+        """
+        Looks up a lap source in the last fetched lap sources.
+
+        Args:
+            lap_source_id (int): The id of the lap source.
+
+        Returns:
+            LapSource | None: The lap source, None if it is unknown.
+        """
+        for lap_source in self._lap_sources:
+            if lap_source.id == lap_source_id:
+                return lap_source
+        return None
+
+    async def _apply_catalog(self, endpoint: str, data: list[dict]):
+        """
+        Parses and publishes a fetched catalog.
+        Teams and sources rarely change, they are only parsed and published when they did.
+
+        Args:
+            endpoint (str): The catalog endpoint.
+            data (list): The catalog.
+
+        Notes:
+            The client returns the same list until the catalog changes. Changes are detected against the list
+            applied here rather than the changed flag of the client, which the routes consume when they
+            refresh the shared catalog.
+        """
+        if data is self._catalogs.get(endpoint):
+            return
+        self._catalogs[endpoint] = data
+        if endpoint == "team":
+            self._teams = [Team(**team) for team in data]
+        elif endpoint == "lap-source":
+            self._lap_sources = [LapSource(**lap_source) for lap_source in data]
+            await self._admin_publisher.publish("lap-source", data)
+        else:
+            await self._admin_publisher.publish("position-source", data)
+
     async def fetch(self):
         """
         Fetches data from the Telraam API and publishes it to the appropriate channels.
+        The endpoints are requested concurrently over the pooled connections of the shared client.
+
+        Notes:
+            Fetches run when triggered by a Telraam websocket event, and otherwise every `interval.fetch`
+            seconds, stretching up to `polling.idle` while the counts don't change and backing off up to
+            `polling.backoff` while Telraam is unhealthy.
         """
-        async with TelraamClient(self._settings, self._admin_publisher) as client:
-            while True:
-                try:
-                    teams: list[dict] = await client.get_teams()  # Get all teams
-                    lap_sources: list[
-                        dict
-                    ] = await client.get_lap_sources()  # Get all lap sources
-
-                    # Get all laps according to the source
-                    if self._settings.lap_source.name == "accepted-laps":
-                        laps: list[dict] = await client.get_accepted_laps()
-                    else:
-                        laps: list[dict] = await client.get_laps()
-
-                    await self._admin_publisher.publish("lap-source", lap_sources)
-
-                    position_sources: list[dict] = await client.get_position_sources()
-                    await self._admin_publisher.publish(
-                        "position-source", position_sources
-                    )
-
-                    # Create models from the fetched data
-                    teams_by_id: dict[int, Team] = {
-                        team["id"]: Team(**team) for team in teams
-                    }
-
-                    lap_sources_by_id: dict[int, LapSource] = {
-                        lap_source["id"]: LapSource(**lap_source)
-                        for lap_source in lap_sources
-                    }
-
-                    # Create Lap models from the fetched data sorted by teams and lap sources
-                    laps: list[Lap] = [
-                        Lap(
-                            team=teams_by_id[lap["teamId"]],
-                            lap_source=lap_sources_by_id[lap["lapSourceId"]],
-                            **lap,
-                        )
-                        for lap in laps
-                    ]
-
-                    # Filter laps by source
-                    if self._settings.lap_source.name != "accepted-laps":
-                        laps: list[Lap] = [
-                            lap
-                            for lap in laps
-                            if lap.lap_source.id == self._settings.lap_source.id
-                        ]
-
-                    # Filter laps by freeze time
-                    if self._settings.site.freeze is not None:
-                        new_laps: list[Lap] = [
-                            lap
-                            for lap in laps
-                            if lap.timestamp <= self._settings.site.freeze
-                        ]
-
-                        # If the filter removed laps, we now the scoreboard is frozen
-                        await self._feed_publisher.publish(
-                            "frozen", len(new_laps) != len(laps)
-                        )
-
-                        laps: list[Lap] = new_laps
-
-                    # Publish the amount of laps to the feed publisher
-                    counts: list[dict] = [
-                        Count(
-                            count=len([lap for lap in laps if lap.team == team]),
-                            team=team,
-                        ).model_dump()
-                        for team in teams_by_id.values()
-                    ]
-
-                    asyncio.create_task(self.storeman.storeScores(counts))
-
-                    await self._feed_publisher.publish("counts", counts)
-                except (ConnectError, AttributeError):
-                    await self._admin_publisher.publish("telraam-health", "bad")
-                except Exception as e:
-                    print(traceback.format_exc(), flush=True)
-
-                await asyncio.sleep(self._settings.interval.fetch)
+        delay: float = self._settings.interval.fetch
+        failures: int = 0
+        while True:
+            # Triggers that arrive during the fetch cause another fetch right after it
+            self._triggered.clear()
+            changed = False
+            try:
+                results = await asyncio.gather(
+                    self._client.get_catalog("team"),
+                    self._client.get_catalog("lap-source"),
+                    self._client.get_catalog("position-source"),
+                    # Get the new laps of every source
+                    self._sync_laps("lap"),
+                    self._sync_laps("accepted-laps"),
+                    return_exceptions=True,
+                )
+
+                # Apply the catalogs that were fetched, even when another request failed
+                for endpoint, result in zip(("team", "lap-source", "position-source"), results):
+                    if not isinstance(result, Exception):
+                        await self._apply_catalog(endpoint, result[0])
+                for result in results:
+                    if isinstance(result, Exception):
+                        raise result
+
+                # Count the laps of every lap source, including the active one if Telraam no longer lists it
+                lap_sources_to_count = list(self._lap_sources)
+                if self._settings.lap_source.id not in {lap_source.id for lap_source in lap_sources_to_count}:
+                    lap_sources_to_count.append(self._settings.lap_source)
+                source_counts = {
+                    lap_source.id: self._count(lap_source) for lap_source in lap_sources_to_count
+                }
+                changed = source_counts != self._source_counts
+                self._source_counts = source_counts
+                failures = 0
+
+                await self._admin_publisher.publish(
+                    "source-counts",
+                    [
+                        {"lap_source": lap_source.model_dump(), "counts": source_counts[lap_source.id]}
+                        for lap_source in self._lap_sources
+                    ],
+                )
+                await self.publish_counts()
+            except (HTTPError, ValueError, AttributeError):
+                failures += 1
+                await self._admin_publisher.publish("telraam-health", "bad")
+            except Exception as e:
+                print(traceback.format_exc(), flush=True)
+
+            delay = self._next_delay(delay, changed, failures)
+            await self._wait(delay, failures)
@@ -0,0 +1,63 @@
+import asyncio
+import math
+import time
+
+from src.mailbox import Mailbox
+from src.tasks.task import Task
+
+# Amount of slots in the timer wheel, each slot covers one second
+WHEEL_SIZE: int = 64
+
+
+class Heartbeat(Task):
+    """
+    Heartbeat class pings the websocket clients that have been idle for the feed interval.
+
+    The clients are kept in a timer wheel keyed on the time their idle interval expires, so every tick
+    only visits the clients that may have become idle instead of every client.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._wheel: list[list[Mailbox]] = [[] for _ in range(WHEEL_SIZE)]
+        self._cursor: int = 0
+
+    def schedule(self, mailbox: Mailbox, deadline: float | None = None):
+        """
+        Schedules a mailbox to be checked at the given deadline.
+
+        Args:
+            mailbox (Mailbox): The mailbox of a client.
+            deadline (float | None): The monotonic time to check the mailbox, one feed interval from now by default.
+        """
+        now = time.monotonic()
+        if deadline is None:
+            deadline = now + self._settings.interval.feed
+        # Deadlines beyond the wheel are checked at the end of the wheel and rescheduled from there
+        ticks = min(max(math.ceil(deadline - now), 1), WHEEL_SIZE - 1)
+        self._wheel[(self._cursor + ticks) % WHEEL_SIZE].append(mailbox)
+
+    def _tick(self):
+        """
+        Advances the wheel by one slot, pinging the idle mailboxes of that slot and rescheduling the others.
+        """
+        self._cursor = (self._cursor + 1) % WHEEL_SIZE
+        due, self._wheel[self._cursor] = self._wheel[self._cursor], []
+
+        now = time.monotonic()
+        for mailbox in due:
+            if mailbox.closed or mailbox.removed:
+                continue
+            deadline = mailbox.last_sent + self._settings.interval.feed
+            if deadline <= now:
+                mailbox.ping()
+                deadline = now + self._settings.interval.feed
+            self.schedule(mailbox, deadline)
+
+    async def run(self):
+        """
+        Advances the wheel every second.
+        """
+        while True:
+            await asyncio.sleep(1)
+            self._tick()
@@ -1,12 +1,85 @@
 import asyncio
+import logging
 import time
 import json
+from collections import OrderedDict
+from hashlib import blake2b
+from typing import Callable
 
 from websockets import connect, InvalidHandshake
 from websockets.exceptions import ConnectionClosed
 
 from src.data_publisher import DataPublisher
 from src.settings import Settings
+from src.tasks.supervisor import backoff
+
+
+class Deduplicator:
+    """
+    Drops the copies of messages that were already received from another upstream, so the first copy wins.
+
+    Messages are identified by a hash of their content. A position is identified by its position source,
+    team and timestamp, so positions that are older than the newest one of their team are dropped as well.
+    Copies from the same upstream are genuine repeats and are never dropped.
+    """
+
+    def __init__(self, window: float):
+        self._window: float = window
+        # Message hash -> upstream and monotonic time of the first copy, oldest first
+        self._seen: OrderedDict[bytes, tuple[int, float]] = OrderedDict()
+        # (position source, team id) -> timestamp and upstream of the newest position
+        self._positions: dict[tuple[str, int], tuple[int, int]] = dict()
+
+    def message(self, upstream: int, message: str) -> bool:
+        """
+        Checks whether a message is the first copy.
+
+        Args:
+            upstream (int): The upstream the message was received from.
+            message (str): The received message.
+
+        Returns:
+            bool: Whether the message should be handled.
+        """
+        now = time.monotonic()
+        while self._seen and next(iter(self._seen.values()))[1] < now - self._window:
+            self._seen.popitem(last=False)
+
+        digest = blake2b(message.encode(), digest_size=16).digest()
+        seen = self._seen.get(digest)
+        if seen is not None and seen[0] != upstream:
+            return False
+        self._seen[digest] = (upstream, now)
+        self._seen.move_to_end(digest)
+        return True
+
+    def positions(self, upstream: int, position_source: str, positions: list[dict]) -> list[dict]:
+        """
+        Returns the positions that are newer than the ones already received.
+
+        Args:
+            upstream (int): The upstream the positions were received from.
+            position_source (str): The position source of the positions.
+            positions (list): The received positions.
+
+        Returns:
+            list: The new positions.
+        """
+        new = []
+        for team_data in positions:
+            timestamp = team_data.get("timestamp")
+            if timestamp is None:
+                new.append(team_data)
+                continue
+            key = (position_source, team_data["team_id"])
+            newest = self._positions.get(key)
+            if newest is not None and (
+                timestamp < newest[0] or (timestamp == newest[0] and upstream != newest[1])
+            ):
+                continue
+            self._positions[key] = (timestamp, upstream)
+            new.append(team_data)
+        return new
 
 
 class WebSocketListener:
@@ -19,48 +92,109 @@ class WebSocketListener:
         settings: Settings,
         _feed_publisher: DataPublisher,
         _admin_publisher: DataPublisher,
+        trigger: Callable[[], None] | None = None,
     ):
         self._settings: Settings = settings
         self._feed_publisher: DataPublisher = _feed_publisher
         self._admin_publisher: DataPublisher = _admin_publisher
+        # Called for the events of the `polling.triggers` topics, to fetch the new data right away
+        self._trigger: Callable[[], None] | None = trigger
+        self._deduplicator: Deduplicator = Deduplicator(settings.telraam.dedup)
+        self._connected: int = 0  # Amount of connected upstreams
+        self.logger = logging.getLogger("uvicorn")
 
     async def start(self):
         """
-        Starts the WebSocket connection and continuously receives messages.
+        Starts the WebSocket connections and continuously receives messages.
 
-        If the connection is closed, it will attempt to reconnect.
+        Every configured upstream is listened to at once, only the first copy of each message is handled.
+        When one of the upstreams fails, the others are cancelled as well, so a restart starts over cleanly.
         """
+        self._connected = 0
         try:
-            async with connect(self._settings.telraam.ws) as ws:
-                await self._admin_publisher.publish("telraam-health", "good")
-                while True:
+            async with asyncio.TaskGroup() as group:
+                for upstream, url in enumerate(self._settings.telraam.websockets()):
+                    group.create_task(self._listen(upstream, url))
+        except ExceptionGroup as e:
+            # Report the error of the upstream that failed first
+            raise e.exceptions[0]
+
+    async def _listen(self, upstream: int, url: str):
+        """
+        Receives the messages of an upstream.
+
+        If the connection is closed or can't be established, it will attempt to reconnect,
+        waiting `interval.websocket` seconds after the first failure and backing off up to
+        `supervisor.max_backoff` seconds while the failures continue. A connection only counts as
+        healthy, resetting the backoff, once it stayed open for `supervisor.healthy` seconds.
+
+        Args:
+            upstream (int): The index of the upstream.
+            url (str): The websocket url of the upstream.
+        """
+        failures = 0
+        while True:
+            connected: float | None = None
+            try:
+                async with connect(url) as ws:
+                    connected = time.monotonic()
+                    self._connected += 1
                     try:
-                        message = await ws.recv()
-                        await self._receive(message)
-                    except ConnectionClosed:
-                        await self.start()
-        except (OSError, InvalidHandshake):
-            await self._admin_publisher.publish("telraam-health", "bad")
-            await asyncio.sleep(self._settings.interval.websocket)
-            await self.start()
-
-    async def _receive(self, message: str):
+                        await self._admin_publisher.publish("telraam-health", "good")
+                        async for message in ws:
+                            try:
+                                await self._receive(message, upstream)
+                            except (ValueError, KeyError, TypeError) as e:
+                                self.logger.warning(f"Ignoring invalid message from {url}: {e}")
+                    finally:
+                        self._connected -= 1
+            except ConnectionClosed:
+                pass
+            except (OSError, InvalidHandshake):
+                # Telraam is only unhealthy when no upstream is connected
+                if not self._connected:
+                    await self._admin_publisher.publish("telraam-health", "bad")
+
+            if connected is not None and time.monotonic() - connected >= self._settings.supervisor.healthy:
+                failures = 0
+            await asyncio.sleep(
+                backoff(
+                    failures,
+                    self._settings.interval.websocket,
+                    self._settings.supervisor.max_backoff,
+                    self._settings.supervisor.jitter,
+                )
+            )
+            failures += 1
+
+    async def _receive(self, message: str, upstream: int = 0):
         """
         Handles the received message by parsing and publishing the data.
 
         Args:
             message (str): The received message as a string.
+            upstream (int): The index of the upstream the message was received from.
         """
+        if not self._deduplicator.message(upstream, message):
+            return
         data: dict[str, str] = json.loads(message)
         if "topic" not in data or "data" not in data:
             raise ValueError("Invalid message from telraam")
 
+        if self._trigger is not None and data["topic"] in self._settings.polling.triggers:
+            self._trigger()
+
         if data["topic"] == "position":
             position_data = data["data"]
             if position_data is None:
                 return
             if "positioner" not in position_data or "positions" not in position_data:
                 raise ValueError("Invalid message from telraam")
+            position_data["positions"] = self._deduplicator.positions(
+                upstream, position_data["positioner"], position_data["positions"]
+            )
+            if not position_data["positions"]:
+                return
             if self._settings.site.freeze != None and self._settings.site.freeze < (time.time() * 1000):
                 for team_data in position_data["positions"]:
                     team_data['progress'] = 0
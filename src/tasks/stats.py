@@ -0,0 +1,23 @@
+import asyncio
+
+from src.tasks.task import Task
+
+
+class StatsReporter(Task):
+    """
+    StatsReporter class periodically publishes the queue statistics of the publishers to the admin feed.
+    """
+
+    async def report(self):
+        """
+        Publishes the queue statistics of both publishers to the admin feed.
+        """
+        while True:
+            await self._admin_publisher.publish(
+                "queue-stats",
+                {
+                    "feed": await self._feed_publisher.stats(),
+                    "admin": await self._admin_publisher.stats(),
+                },
+            )
+            await asyncio.sleep(self._settings.interval.feed)
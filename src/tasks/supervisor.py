@@ -0,0 +1,138 @@
+import asyncio
+import logging
+import random
+import time
+from typing import Awaitable, Callable
+
+from src.data_publisher import DataPublisher
+from src.settings import Settings
+from src.tasks.task import Task
+
+
+def backoff(attempt: int, base: float, maximum: float, jitter: float) -> float:
+    """
+    Returns the time to wait before the next attempt, doubling after every failed attempt.
+
+    Args:
+        attempt (int): The amount of failed attempts in a row, starting at 0.
+        base (float): The time to wait after the first failed attempt.
+        maximum (float): The maximum time to wait.
+        jitter (float): The fraction of the time that is randomised, so retries don't happen in lockstep.
+
+    Returns:
+        float: The time to wait in seconds.
+    """
+    delay = min(base * 2 ** min(attempt, 32), maximum)
+    return delay * (1 - jitter * random.random())
+
+
+class _Supervised:
+    """
+    A supervised task and its state.
+    """
+
+    __slots__ = ("name", "factory", "task", "state", "restarts", "error")
+
+    def __init__(self, name: str, factory: Callable[[], Awaitable[None]]):
+        self.name: str = name
+        self.factory: Callable[[], Awaitable[None]] = factory
+        self.task: asyncio.Task | None = None
+        self.state: str = "running"  # running, restarting or stopped
+        self.restarts: int = 0
+        self.error: str | None = None  # The last crash
+
+    def dump(self) -> dict:
+        return {"name": self.name, "state": self.state, "restarts": self.restarts, "error": self.error}
+
+
+class TaskSupervisor(Task):
+    """
+    TaskSupervisor class runs the background loops of Loxsi and restarts them when they crash.
+
+    A crashed task is restarted after an exponential backoff with jitter, which is reset once the task
+    has been running for `supervisor.healthy` seconds. The state and restart count of every task is
+    published to the `tasks` topic of the admin feed. Closing the supervisor cancels every task.
+    """
+
+    def __init__(
+        self,
+        settings: Settings,
+        feed_publisher: DataPublisher,
+        admin_publisher: DataPublisher,
+        publish_states: bool = True,
+    ):
+        super().__init__(settings, feed_publisher, admin_publisher)
+        # Workers don't publish the states, the admin feed shows the tasks of the ingest process
+        self._publish_states: bool = publish_states
+        self._supervised: dict[str, _Supervised] = dict()
+        self.logger = logging.getLogger("uvicorn")
+
+    def supervise(self, name: str, factory: Callable[[], Awaitable[None]]):
+        """
+        Starts running a task under supervision.
+
+        Args:
+            name (str): The name of the task, shown on the admin feed.
+            factory (Callable): Creates the coroutine of the task, called again on every restart.
+        """
+        supervised = _Supervised(name, factory)
+        self._supervised[name] = supervised
+        supervised.task = asyncio.create_task(self._run(supervised), name=name)
+
+    async def _run(self, supervised: _Supervised):
+        """
+        Runs a task until it returns, restarting it whenever it crashes.
+
+        Args:
+            supervised (_Supervised): The task.
+        """
+        settings = self._settings.supervisor
+        failures = 0
+        while True:
+            started = time.monotonic()
+            try:
+                await supervised.factory()
+                supervised.state = "stopped"
+                await self._publish()
+                return
+            except Exception as e:
+                if time.monotonic() - started >= settings.healthy:
+                    failures = 0
+                self.logger.exception(f"Task {supervised.name} crashed, restarting")
+                supervised.state = "restarting"
+                supervised.error = f"{type(e).__name__}: {e}"
+                await self._publish()
+
+            await asyncio.sleep(backoff(failures, settings.backoff, settings.max_backoff, settings.jitter))
+            failures += 1
+            supervised.restarts += 1
+            supervised.state = "running"
+            await self._publish()
+
+    async def _publish(self):
+        if self._publish_states:
+            await self._admin_publisher.publish("tasks", self.states())
+
+    def states(self) -> list[dict]:
+        """
+        Returns the state of every supervised task.
+
+        Returns:
+            list: The name, state, restart count and last error of every task.
+        """
+        return [supervised.dump() for supervised in self._supervised.values()]
+
+    async def start(self):
+        """
+        Publishes the initial states.
+        """
+        await self._publish()
+
+    async def close(self):
+        """
+        Cancels every task and waits for them to finish.
+        """
+        tasks = [supervised.task for supervised in self._supervised.values() if supervised.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
@@ -0,0 +1,56 @@
+import asyncio
+import time
+
+from src.tasks.task import Task
+
+
+class PositionTicker(Task):
+    """
+    PositionTicker class drives the position rate classes of the feed publisher.
+    Every rate class ticks at its own rate, sending the positions merged since its previous tick.
+    The rates are checked every `interval.config` seconds, so edited rates apply without a restart.
+    Rate classes that are no longer configured keep ticking until their last client left.
+    """
+
+    async def _tick(self, position_hz: int):
+        """
+        Ticks a rate class until cancelled.
+
+        Args:
+            position_hz (int): The rate class.
+        """
+        period = 1 / position_hz
+        deadline = time.monotonic()
+        while True:
+            # Sleep until the next deadline, so slow ticks don't make the rate drift
+            deadline += period
+            await asyncio.sleep(max(0.0, deadline - time.monotonic()))
+            await self._feed_publisher.tick(position_hz)
+            deadline = max(deadline, time.monotonic() - period)
+
+    async def run(self):
+        """
+        Ticks every rate class until cancelled.
+        """
+        tickers: dict[int, asyncio.Task] = dict()
+        try:
+            while True:
+                wanted = set(self._settings.positions.rates) | self._feed_publisher.rate_classes()
+                for position_hz in wanted - tickers.keys():
+                    tickers[position_hz] = asyncio.create_task(self._tick(position_hz))
+                for position_hz in tickers.keys() - wanted:
+                    tickers.pop(position_hz).cancel()
+
+                if not tickers:
+                    await asyncio.sleep(self._settings.interval.config)
+                    continue
+                done, _ = await asyncio.wait(
+                    tickers.values(), timeout=self._settings.interval.config, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    # A tick crashed, let the supervisor restart the ticker
+                    task.result()
+        finally:
+            for task in tickers.values():
+                task.cancel()
+            await asyncio.gather(*tickers.values(), return_exceptions=True)
@@ -1,37 +1,272 @@
-from httpx import AsyncClient, Response
+import asyncio
+import json
+import re
+import time
+from hashlib import blake2b
+from typing import Awaitable, Callable, TypeVar
+
+from httpx import AsyncClient, HTTPError, Limits, Response
+
+try:
+    import h2
+except ImportError:  # h2 is an optional dependency, requests use HTTP/1.1 without it
+    h2 = None
 
 from src.data_publisher import DataPublisher
+from src.laps import LapColumns
 from src.settings import Settings
 
+_decoder = json.JSONDecoder()
+_array_start = re.compile(r"\s*\[")
+_separator = re.compile(r"[\s,]*")
+
+T = TypeVar("T")
+
+
+def _decode_laps(buffer: str, position: int, laps: LapColumns) -> tuple[int, bool]:
+    """
+    Decodes the complete laps in a part of a JSON array of laps.
+
+    Args:
+        buffer (str): The received part of the array.
+        position (int): The position of the first lap in the buffer.
+        laps (LapColumns): The columns the decoded laps are appended to.
+
+    Returns:
+        tuple: The position of the first lap that is not complete yet and whether the end of the array was reached.
+    """
+    while True:
+        position = _separator.match(buffer, position).end()
+        if position == len(buffer):
+            return position, False
+        if buffer[position] == "]":
+            return position + 1, True
+        try:
+            lap, position_end = _decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            # The rest of the lap is in the next chunk
+            return position, False
+        laps.append(lap)
+        position = position_end
+
+
+class Catalog:
+    """
+    Cached response of a slowly changing Telraam endpoint
+    """
+
+    __slots__ = ("data", "etag", "digest", "checked")
+
+    def __init__(self, data: list, etag: str | None, digest: bytes, checked: float) -> None:
+        self.data: list = data
+        self.etag: str | None = etag  # ETag of the response, if Telraam sent one
+        self.digest: bytes = digest  # Hash of the response body
+        self.checked: float = checked  # Monotonic time of the last request
+
 
 class TelraamClient(AsyncClient):
+    """
+    Client for the Telraam API.
+    A single client is shared by the fetcher and the routes, so connections are pooled and kept alive.
+    When replicas are configured, every request is sent to all upstreams at once and the first answer is used.
+    """
+
     def __init__(
         self, settings: Settings, admin_publisher: DataPublisher, *args, **kwargs
     ):
+        http = settings.telraam.http
+        kwargs.setdefault(
+            "limits",
+            Limits(
+                max_connections=http.connections,
+                max_keepalive_connections=http.keep_alive,
+                keepalive_expiry=http.keep_alive_expiry,
+            ),
+        )
+        kwargs.setdefault("http2", http.http2 and h2 is not None)
+        kwargs.setdefault("timeout", http.timeout)
         super().__init__(*args, **kwargs)
         self._settings: Settings = settings
         self._admin_publisher: DataPublisher = admin_publisher
+        self._catalogs: dict[str, Catalog] = dict()
+
+    async def _first(
+        self, request: Callable[[str], Awaitable[T]], rank: Callable[[T], int] | None = None
+    ) -> T:
+        """
+        Sends a request to every upstream at once and returns the first successful answer.
+        The requests to the other upstreams are cancelled.
+        Server errors only count as an answer when no upstream answered successfully.
+
+        Args:
+            request (Callable): Sends the request to the given API url.
+            rank (Callable | None): Ranks the completeness of an answer. If given, every upstream is awaited
+                and the most complete answer is returned, so a lagging node can't win the race.
+
+        Returns:
+            T: The first answer, or the most complete one.
+
+        Raises:
+            HTTPError | ValueError: The error of the last upstream that failed, if no upstream answered.
+        """
+        apis = self._settings.telraam.apis()
+        if len(apis) == 1:
+            return await request(apis[0])
+
+        tasks = [asyncio.create_task(request(api)) for api in apis]
+        try:
+            error: Exception | None = None
+            fallback: T | None = None
+            best: T | None = None
+            for task in asyncio.as_completed(tasks):
+                try:
+                    answer = await task
+                except (HTTPError, ValueError) as e:
+                    error = e
+                    continue
+                # A restarting upstream answers with a server error, wait for the others
+                if isinstance(answer, Response) and answer.is_server_error:
+                    fallback = answer
+                    continue
+                if rank is None:
+                    return answer
+                if best is None or rank(answer) > rank(best):
+                    best = answer
+            if best is not None:
+                return best
+            if fallback is not None:
+                return fallback
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
 
-    async def _get(self, endpoint: str) -> list:
-        response: Response = await self.get(f"{self._settings.telraam.api}/{endpoint}")
+    async def _get_laps(self, endpoint: str, params: dict | None = None) -> LapColumns:
+        """
+        Gets a list of laps from the first upstream that answers.
+        A full list replaces the local copy of the laps, so it comes from the upstream with the highest lap id.
 
+        Args:
+            endpoint (str): The lap endpoint.
+            params (dict | None): The query parameters, None for every lap.
+
+        Returns:
+            LapColumns: The laps.
+        """
+        return await self._first(
+            lambda api: self._stream_laps(api, endpoint, params),
+            (lambda laps: max(laps.id, default=-1)) if params is None else None,
+        )
+
+    async def _stream_laps(self, api: str, endpoint: str, params: dict | None = None) -> LapColumns:
+        """
+        Gets a list of laps, decoding the response while it streams in.
+        Only the fields Loxsi uses are kept, as columns, so no full copy of the response is ever held in memory.
+
+        Args:
+            api (str): The API url of the upstream.
+            endpoint (str): The lap endpoint.
+            params (dict | None): The query parameters.
+
+        Returns:
+            LapColumns: The laps.
+
+        Raises:
+            HTTPStatusError: If Telraam answered with an error.
+            ValueError: If the response is not a list of laps.
+        """
+        laps = LapColumns.empty()
+        async with self.stream(
+            "GET", f"{api}/{endpoint}", params=params, timeout=self._endpoint_timeout(endpoint)
+        ) as response:
+            # Error bodies are never decoded as laps, an empty list would wipe the store
+            response.raise_for_status()
+            buffer, position, started, ended = "", 0, False, False
+            async for chunk in response.aiter_text():
+                buffer = buffer[position:] + chunk
+                position = 0
+                if not started:
+                    start = _array_start.match(buffer)
+                    if start is None:
+                        if buffer.strip():
+                            raise ValueError("Invalid laps from telraam")
+                        continue
+                    position, started = start.end(), True
+                position, ended = _decode_laps(buffer, position, laps)
+                if ended:
+                    break
+
+        if not ended:
+            raise ValueError("Invalid laps from telraam")
         await self._admin_publisher.publish("telraam-health", "good")
+        return laps
+
+    def _endpoint_timeout(self, endpoint: str) -> float:
+        return self._settings.telraam.http.timeouts.get(endpoint, self._settings.telraam.http.timeout)
+
+    async def get_catalog(self, endpoint: str, refresh: bool = False) -> tuple[list, bool]:
+        """
+        Gets a slowly changing endpoint (teams, lap sources, position sources).
+
+        The response is cached for `interval.catalog` seconds. After that the endpoint is requested again,
+        conditionally if Telraam sent an ETag. A response with the same content hash as the cached one
+        is not parsed again.
+
+        Args:
+            endpoint (str): The endpoint.
+            refresh (bool): Request the endpoint even if the cached response is recent.
+
+        Returns:
+            tuple: The data and whether it changed since the previous call.
+
+        Raises:
+            HTTPStatusError: If Telraam answered with an error.
+        """
+        catalog = self._catalogs.get(endpoint)
+        now = time.monotonic()
+        if not refresh and catalog is not None and now - catalog.checked < self._settings.interval.catalog:
+            return catalog.data, False
+
+        headers = {"If-None-Match": catalog.etag} if catalog is not None and catalog.etag else None
+        response: Response = await self._first(
+            lambda api: self.get(f"{api}/{endpoint}", headers=headers, timeout=self._endpoint_timeout(endpoint))
+        )
+
+        # Error bodies are never cached as a catalog
+        if response.status_code != 304 or catalog is None:
+            response.raise_for_status()
+        await self._admin_publisher.publish("telraam-health", "good")
+
+        digest = blake2b(response.content, digest_size=16).digest()
+        if catalog is not None and (response.status_code == 304 or digest == catalog.digest):
+            catalog.checked = now
+            catalog.etag = response.headers.get("ETag", catalog.etag)
+            return catalog.data, False
+
+        data = response.json()
+        if endpoint == "lap-source":
+            data.append({"id": -1, "name": "accepted-laps"})
+        self._catalogs[endpoint] = Catalog(data, response.headers.get("ETag"), digest, now)
+        return data, True
 
-        return response.json()
+    async def get_lap_sources(self, refresh: bool = False) -> list[dict]:
+        return (await self.get_catalog("lap-source", refresh))[0]
 
-    async def get_lap_sources(self) -> list[dict]:
-        lap_sources = await self._get("lap-source")
-        lap_sources.append({"id": -1, "name": "accepted-laps"})
-        return lap_sources
+    async def get_position_sources(self, refresh: bool = False) -> list[dict]:
+        return (await self.get_catalog("position-source", refresh))[0]
 
-    async def get_position_sources(self) -> list[dict]:
-        return await self._get("position-source")
+    def _cursor(self, after: int | None) -> dict | None:
+        # Only ask for the laps after the cursor, laps are deduplicated by id if Telraam ignores it
+        if after is None or self._settings.telraam.lap_cursor is None:
+            return None
+        return {self._settings.telraam.lap_cursor: after}
 
-    async def get_laps(self) -> list[dict]:
-        return await self._get("lap")
+    async def get_laps(self, after: int | None = None) -> LapColumns:
+        return await self._get_laps("lap", self._cursor(after))
 
     async def get_teams(self) -> list[dict]:
-        return await self._get("team")
+        return (await self.get_catalog("team"))[0]
 
-    async def get_accepted_laps(self) -> list[dict]:
-        return await self._get("accepted-laps")
+    async def get_accepted_laps(self, after: int | None = None) -> LapColumns:
+        return await self._get_laps("accepted-laps", self._cursor(after))
@@ -1,11 +1,17 @@
 import asyncio
+import json
 
 import starlette.websockets
+from starlette.websockets import WebSocketState
 from fastapi import WebSocket
-from fastapi.encoders import jsonable_encoder
+from starlette.status import WS_1008_POLICY_VIOLATION, WS_1013_TRY_AGAIN_LATER
 
 from src.data_publisher import DataPublisher
+from src.encoding import Frame
+from src.mailbox import Mailbox, MailboxClosed
+from src.models import FeedOptions
 from src.settings import Settings
+from src.tasks.heartbeat import Heartbeat
 
 
 class ConnectionTracker:
@@ -41,7 +47,8 @@ class WebSocketHandler:
             self,
             settings: Settings,
             publisher: DataPublisher,
-            connection_tracker: ConnectionTracker
+            connection_tracker: ConnectionTracker,
+            heartbeat: Heartbeat
     ):
         """
         Initializes a new instance of the WebSocket class.
@@ -50,59 +57,86 @@ class WebSocketHandler:
             settings (Settings): The settings object containing configuration options.
             publisher (DataPublisher): The data publisher object used for publishing data.
             connection_tracker (ConnectionTracker): Track the connection count.
+            heartbeat (Heartbeat): Pings the idle clients.
         """
         self._settings: Settings = settings
         self._publisher: DataPublisher = publisher
         self._connection_tracker: ConnectionTracker = connection_tracker
+        self._heartbeat: Heartbeat = heartbeat
+        self._handshakes: asyncio.Semaphore = asyncio.Semaphore(settings.admission.handshakes)
 
-    async def connect(self, websocket: WebSocket):
+    async def connect(self, websocket: WebSocket, options: FeedOptions = FeedOptions()):
         """
         Connects a WebSocket client and starts handling messages.
 
         Args:
             websocket (WebSocket): The WebSocket connection object.
+            options (FeedOptions): The feed options requested by the client.
 
         Notes:
             This method accepts the WebSocket connection, adds the client to the data publisher,
-            and starts handling messages by calling the `_handle_connect` method.
+            and starts sending and receiving messages until either side stops.
+            Only a limited amount of handshakes are handled at once, the others wait for their turn.
+            Clients that waited too long are accepted and closed right away with code 1013, try again later.
         """
-        await websocket.accept()
+        try:
+            await asyncio.wait_for(self._handshakes.acquire(), timeout=self._settings.admission.timeout)
+        except asyncio.exceptions.TimeoutError:
+            # Closing before the handshake is sent as an HTTP 403, accept first so the client sees the close code
+            await websocket.accept()
+            await websocket.close(code=WS_1013_TRY_AGAIN_LATER)
+            return
 
-        queue = await self._publisher.add()
-        await self._connection_tracker.inc()
+        try:
+            await websocket.accept()
+            queue = await self._publisher.add(options)
+            self._heartbeat.schedule(queue)
+            await self._connection_tracker.inc()
+        finally:
+            self._handshakes.release()
 
+        tasks = {
+            asyncio.create_task(self._send(websocket, queue)),
+            asyncio.create_task(self._receive(websocket, queue)),
+        }
         try:
-            await self._send(websocket, queue)
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
         finally:
+            for task in tasks:
+                if task.done() and not task.cancelled() and task.exception() is not None:
+                    print(task.exception())
+                task.cancel()
             await self._connection_tracker.dec()
             await self._publisher.remove(queue)
+            # Let the client know when the connection ended on our side
+            if websocket.client_state != WebSocketState.DISCONNECTED:
+                try:
+                    await websocket.close()
+                except RuntimeError:
+                    pass
 
-    async def _send(self, websocket: WebSocket, queue: asyncio.Queue):
+    async def _send(self, websocket: WebSocket, queue: Mailbox):
         """
         Sends messages to the WebSocket client.
 
         Args:
             websocket (WebSocket): The WebSocket connection object.
-            queue (asyncio.Queue): The queue for receiving messages from the data publisher.
+            queue (Mailbox): The queue for receiving messages from the data publisher.
 
         Notes:
             This method continuously waits for messages from the queue and sends them to the
-            WebSocket client. If the feed timeout is reached, it sends a ping message to keep
-            the connection alive.
+            WebSocket client. The frames are already encoded by the data publisher and are sent
+            as-is. Idle clients get a ping message from the heartbeat to keep the connection alive.
+            If the queue was closed by its overflow policy, the connection is closed.
         """
-
-        async def _feed():
-            return await queue.get()
-
         while True:
             try:
                 try:
-                    topic, data = await asyncio.wait_for(
-                        _feed(), timeout=self._settings.interval.feed
-                    )
-                    await websocket.send_json({'topic': topic, 'data': jsonable_encoder(data)})
-                except asyncio.exceptions.TimeoutError:
-                    await websocket.send_json({'ping': 'pong'})
+                    frame: Frame = await queue.get()
+                    await self._send_frame(websocket, frame)
+                except MailboxClosed:
+                    await websocket.close(code=WS_1008_POLICY_VIOLATION, reason="Client is lagging behind")
+                    return
                 except Exception as e:
                     raise e
             except starlette.websockets.WebSocketDisconnect:
@@ -110,3 +144,59 @@ class WebSocketHandler:
             except Exception as e:
                 print(e)
                 return
+
+    @staticmethod
+    async def _send_frame(websocket: WebSocket, frame: Frame):
+        """
+        Sends an encoded frame, binary formats are sent as binary messages.
+
+        Args:
+            websocket (WebSocket): The WebSocket connection object.
+            frame (Frame): The encoded frame.
+        """
+        if isinstance(frame, bytes):
+            await websocket.send_bytes(frame)
+        else:
+            await websocket.send_text(frame)
+
+    async def _receive(self, websocket: WebSocket, queue: Mailbox):
+        """
+        Receives requests from the WebSocket client.
+
+        Args:
+            websocket (WebSocket): The WebSocket connection object.
+            queue (Mailbox): The queue of the client.
+
+        Notes:
+            A client changes its subscriptions by sending `{"subscribe": [<topic>, ...]}`,
+            or `{"subscribe": null}` to receive every topic.
+            A delta client that detects a gap in the versions sends `{"resync": <topic>}`
+            to receive a new snapshot of the topic. Sending `{"history": true}` requests the recent positions
+            of every team. Requests are always JSON, also for binary formats.
+            Invalid requests are ignored.
+        """
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    return
+                try:
+                    request = json.loads(message.get("text") or message.get("bytes") or "")
+                except ValueError:
+                    continue
+                if not isinstance(request, dict):
+                    continue
+                if "subscribe" in request:
+                    topics = request["subscribe"]
+                    if isinstance(topics, list):
+                        await self._publisher.subscribe(
+                            queue, [topic for topic in topics if isinstance(topic, str)]
+                        )
+                    elif topics is None:
+                        await self._publisher.subscribe(queue, None)
+                if isinstance(request.get("resync"), str):
+                    await self._publisher.resync(queue, request["resync"])
+                if request.get("history") is True:
+                    await self._publisher.history(queue)
+        except (starlette.websockets.WebSocketDisconnect, RuntimeError):
+            return
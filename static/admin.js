@@ -58,7 +58,15 @@ let message_handlers = {
     for (const lap_source of data) {
       sources.innerHTML += '<div class="col l6 m12 s12" style="margin-top: 20px">' +
         `<button class="tui-button white-168 white-255-hover" onclick="lapUse(this)" value="${lap_source.id}" style="width: 100%">` +
-        `${lap_source.name} </button></div>`
+        `${lap_source.name} <span id="lap-source-total-${lap_source.id}"></span></button></div>`
+    }
+  },
+  'source-counts': data => {
+    for (const source of data) {
+      let total = document.getElementById(`lap-source-total-${source.lap_source.id}`)
+      if (total) {
+        total.innerText = `(${source.counts.reduce((sum, count) => sum + count.count, 0)} laps)`
+      }
     }
   },
   'position-source': data => {
@@ -73,6 +81,12 @@ let message_handlers = {
   'active-connections': data => {
     document.getElementById('active-connections').innerText = `Count: ${data}`;
   },
+  'tasks': data => {
+    let failing = data.filter(task => task.state !== 'running')
+    document.getElementById('tasks').innerText = failing.length === 0
+      ? `Tasks: ${data.length} running`
+      : `Tasks: ${failing.map(task => `${task.name} ${task.state} (${task.restarts} restarts)`).join(', ')}`;
+  },
   'freeze': data => {
     document.getElementById('freeze-time').value = new Date(data + (2 * 60 * 60 * 1000)).toISOString().substring(0, 16);
   }